@@ -2,8 +2,12 @@
 # Copyright (c) 2023 mizmu addons 
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-from.mizmu_addons_menu import menu
-from . import cropro
+from aqt import mw
 
-cropro.init()
+# mw is None when the add-on is imported outside of Anki, e.g. to run headless.py.
+if mw is not None:
+    from .mizmu_addons_menu import menu
+    from . import cropro
+
+    cropro.init()
 
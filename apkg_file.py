@@ -0,0 +1,211 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import json
+import os
+import threading
+import unicodedata
+import zipfile
+from typing import Callable, Optional, BinaryIO
+
+from anki.importing.anki2 import MediaMapInvalid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Called as progress(stage, done, total) while a package is being extracted.
+ProgressFn = Callable[[str, int, int], None]
+
+# Stages reported to ProgressFn.
+STAGE_INDEX = "Reading package index"
+STAGE_COLLECTION = "Extracting collection"
+STAGE_MEDIA = "Extracting media"
+
+# Size of a single read when copying data out of a package.
+# Peak memory used by the copy doesn't depend on the size of the package.
+CHUNK_SIZE = 1024 * 1024
+
+# Packages exported by Anki 2.1.50+ store a zstd-compressed collection,
+# a zstd-compressed protobuf media map and zstd-compressed media files.
+MODERN_COLLECTION = "collection.anki21b"
+
+
+def zstd_decompressor() -> 'zstandard.ZstdDecompressor':
+    if zstandard is None:
+        raise RuntimeError(
+            "This package was exported by Anki 2.1.50 or newer and is compressed with zstd. "
+            "Opening it requires the 'zstandard' Python module, which Anki doesn't include. "
+            "Either run \"python -m pip install zstandard\" with the Python that runs Anki "
+            "(e.g. when Anki was installed with pip), "
+            "or export the deck again with \"Support older Anki versions\" checked."
+        )
+    return zstandard.ZstdDecompressor()
+
+
+def is_modern_package(z: zipfile.ZipFile) -> bool:
+    return MODERN_COLLECTION in z.namelist()
+
+
+def collection_member(z: zipfile.ZipFile) -> str:
+    if is_modern_package(z):
+        return MODERN_COLLECTION
+    # v2 scheduler?
+    try:
+        z.getinfo("collection.anki21")
+        return "collection.anki21"
+    except KeyError:
+        return "collection.anki2"
+
+
+def copy_stream(src: BinaryIO, dest: BinaryIO, total: int, stage: str, progress: Optional[ProgressFn] = None) -> int:
+    """
+    Copies src to dest in bounded chunks.
+    Returns the number of bytes written.
+    """
+    done = 0
+    while chunk := src.read(CHUNK_SIZE):
+        dest.write(chunk)
+        done += len(chunk)
+        if progress:
+            progress(stage, done, total)
+    return done
+
+
+def stream_member_to_file(
+        z: zipfile.ZipFile,
+        member: str,
+        dest_path: str,
+        progress: Optional[ProgressFn] = None,
+        decompress: bool = False,
+        stage: Optional[str] = None,
+) -> int:
+    """
+    Extracts a zip member to dest_path without loading it into memory.
+    If decompress is set, the member is zstd-decompressed on the fly.
+    Returns the number of bytes written.
+    """
+    total = z.getinfo(member).file_size
+    stage = stage or member
+    with z.open(member) as src, open(dest_path, 'wb') as dest:
+        if not decompress:
+            return copy_stream(src, dest, total, stage=stage, progress=progress)
+        with zstd_decompressor().stream_reader(src, closefd=False) as reader:
+            # The size of the decompressed data is unknown, report how much of the member has been consumed.
+            return copy_stream(
+                reader, dest, total, stage=stage,
+                progress=progress and (lambda stage, _done, _total: progress(stage, src.tell(), _total)),
+            )
+
+
+def extract_collection(z: zipfile.ZipFile, dest_path: str, progress: Optional[ProgressFn] = None) -> int:
+    """Extracts the collection of a legacy or a modern package to dest_path."""
+    member = collection_member(z)
+    return stream_member_to_file(
+        z, member, dest_path,
+        progress=progress,
+        decompress=(member == MODERN_COLLECTION),
+        stage=STAGE_COLLECTION,
+    )
+
+
+def read_legacy_media_map(z: zipfile.ZipFile) -> dict[str, str]:
+    """Parses the json media map of a legacy package. Maps zip members to file names."""
+    return json.loads(z.read("media").decode("utf8"))
+
+
+def read_modern_media_map(z: zipfile.ZipFile) -> dict[str, str]:
+    """Parses the zstd-compressed protobuf media map of a modern package. Maps zip members to file names."""
+    from anki.import_export_pb2 import MediaEntries
+
+    with z.open("media") as src, zstd_decompressor().stream_reader(src, closefd=False) as reader:
+        entries = MediaEntries.FromString(reader.read())
+    return {
+        str(entry.legacy_zip_filename if entry.HasField("legacy_zip_filename") else idx): entry.name
+        for idx, entry in enumerate(entries.entries)
+    }
+
+
+def read_media_map(z: zipfile.ZipFile, media_dir: str) -> dict[str, str]:
+    """
+    Parses the media map of a package.
+    Returns a dict mapping file names to zip members.
+    """
+    try:
+        media_dict = read_modern_media_map(z) if is_modern_package(z) else read_legacy_media_map(z)
+    except RuntimeError:
+        # zstandard isn't available.
+        raise
+    except Exception as exc:
+        raise MediaMapInvalid() from exc
+    name_to_member = {}
+    for member, file_name in media_dict.items():
+        path = os.path.abspath(os.path.join(media_dir, file_name))
+        if os.path.commonprefix([path, media_dir]) != media_dir:
+            raise Exception("Invalid file")
+        name_to_member[unicodedata.normalize("NFC", file_name)] = member
+    return name_to_member
+
+
+class MediaIndex:
+    """
+    Knows which media files a package contains and extracts them on demand.
+    Files that were already extracted are served from disk.
+    """
+
+    def __init__(self, z: zipfile.ZipFile, media_dir: str):
+        self._zip = z
+        self._dir = media_dir
+        self._lock = threading.Lock()
+        self._compressed = is_modern_package(z)
+        self._name_to_member = read_media_map(z, media_dir)
+
+    @property
+    def dir(self) -> str:
+        return self._dir
+
+    def __len__(self) -> int:
+        return len(self._name_to_member)
+
+    def __contains__(self, file_name: str) -> bool:
+        return unicodedata.normalize("NFC", file_name) in self._name_to_member
+
+    def file_path(self, file_name: str) -> Optional[str]:
+        """
+        Returns the path to a media file, extracting it first if needed.
+        Returns None if the package doesn't contain the file.
+        """
+        file_name = unicodedata.normalize("NFC", file_name)
+        path = os.path.join(self._dir, file_name)
+        if os.path.isfile(path):
+            return path
+        if (member := self._name_to_member.get(file_name)) is None:
+            return None
+        with self._lock:
+            if not os.path.isfile(path):
+                self._extract(member, path)
+        return path
+
+    def extract_all(self, progress: Optional[ProgressFn] = None) -> None:
+        total = len(self._name_to_member)
+        for done, file_name in enumerate(self._name_to_member, start=1):
+            self.file_path(file_name)
+            if progress:
+                progress(STAGE_MEDIA, done, total)
+
+    def close(self) -> None:
+        self._zip.close()
+
+    def _extract(self, member: str, path: str) -> None:
+        # Write to a temporary name first so that an interrupted extraction
+        # never leaves a truncated file that would be served later.
+        part_path = f"{path}.part"
+        try:
+            stream_member_to_file(self._zip, member, part_path, decompress=self._compressed)
+        except BaseException:
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, path)
@@ -0,0 +1,3 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
@@ -0,0 +1,182 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Times opening, searching, filling the result list, previewing and importing at several package sizes.
+
+Run from the addons21 folder, with Anki closed:
+    python -m <add-on folder>.benchmarks.run --sizes 1000,10000,100000 --output before.json
+
+Compare the JSON files written by two versions of the add-on to spot regressions.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from typing import Optional, Sequence
+
+from anki.buildinfo import version as anki_version
+from anki.collection import Collection
+
+from .synthetic import PackageSpec, SyntheticPackage, make_package
+from ..collection_manager import CollectionManager, NameId, remove_collection_files
+from ..headless import Stopwatch
+from ..import_ledger import ImportLedger, LEDGER_FILE_NAME
+from ..note_importer import NoteImporter, ImportOptions
+from ..package_cache import package_cache
+from ..preview_renderer import PreviewRenderer
+from ..row_renderer import RowRenderer
+from ..thumbnails import ThumbnailCache
+
+# Rows are read in pages of this size when the result list is scrolled.
+LIST_PAGE_SIZE = 100
+
+
+def time_list_fill(stopwatch: Stopwatch, manager: CollectionManager, note_ids: Sequence[int]) -> None:
+    package = manager.package
+    renderer = RowRenderer()
+    with stopwatch.stage('list_fill'):
+        for start in range(0, len(note_ids), LIST_PAGE_SIZE):
+            for row in package.fetch_rows(note_ids[start:start + LIST_PAGE_SIZE]):
+                renderer.text(package, row)
+
+
+def time_preview(stopwatch: Stopwatch, manager: CollectionManager, note_ids: Sequence[int], work_dir: str) -> None:
+    package = manager.package
+    thumbnails_dir = os.path.join(work_dir, 'thumbnails')
+    shutil.rmtree(thumbnails_dir, ignore_errors=True)
+    renderer = PreviewRenderer(thumbnails=ThumbnailCache(thumbnails_dir))
+    # The first pass creates thumbnails, the second one renders the same notes again, e.g. after a new search.
+    with stopwatch.stage('preview_cold'):
+        for note_id in note_ids:
+            renderer.note_html(package, note_id)
+    renderer = PreviewRenderer(thumbnails=ThumbnailCache(thumbnails_dir))
+    with stopwatch.stage('preview_warm'):
+        for note_id in note_ids:
+            renderer.note_html(package, note_id)
+
+
+def time_import(stopwatch: Stopwatch, manager: CollectionManager, note_ids: Sequence[int], col_path: str) -> dict:
+    # Always import into an empty collection with an empty ledger.
+    remove_collection_files(col_path)
+    ledger_path = os.path.join(os.path.dirname(col_path), LEDGER_FILE_NAME)
+    if os.path.isfile(ledger_path):
+        os.remove(ledger_path)
+    col = Collection(col_path)
+    ledger = ImportLedger()
+    ledger.open(col_path)
+    try:
+        with stopwatch.stage('import'):
+            summary = NoteImporter(
+                col=col,
+                model_id=NameId.none_type().id,
+                deck_id=col.decks.id("Imported", create=True),
+                options=ImportOptions(),
+                ledger=ledger,
+            ).import_notes([manager.get_source_note(note_id) for note_id in note_ids])
+    finally:
+        ledger.close()
+        col.close()
+    return {'imported': summary.successes, 'notes_per_second': round(summary.notes_per_second, 2)}
+
+
+def run_one(package: SyntheticPackage, work_dir: str, preview_count: int, import_count: int) -> dict:
+    stopwatch = Stopwatch()
+    manager = CollectionManager()
+    result = {'notes': package.spec.notes, 'found': {}}
+    try:
+        with stopwatch.stage('open_cold'):
+            manager.open(package.path)
+        manager.close_all()
+        # Reuses the extracted collection if the package cache is enabled.
+        with stopwatch.stage('open_warm'):
+            manager.open(package.path)
+        whole_collection = manager.col_name_and_id()
+        for kind, query in package.queries().items():
+            with stopwatch.stage(f'search_{kind}'):
+                result['found'][kind] = len(manager.find_notes(whole_collection, query))
+        with stopwatch.stage('search_repeated'):
+            note_ids = manager.find_notes(whole_collection, package.queries()['common_word'])
+        time_list_fill(stopwatch, manager, note_ids)
+        time_preview(stopwatch, manager, note_ids[:preview_count], work_dir)
+        target_path = os.path.join(work_dir, f'target_{package.spec.notes}.anki2')
+        result.update(time_import(stopwatch, manager, note_ids[:import_count], target_path))
+    finally:
+        manager.close_all()
+    result['timings'] = stopwatch.finish()
+    return result
+
+
+def run(sizes: Sequence[int], base_spec: PackageSpec, work_dir: str, preview_count: int, import_count: int) -> dict:
+    package_cache.set_root(work_dir)
+    results = []
+    for size in sizes:
+        spec = base_spec._replace(notes=size)
+        stopwatch = Stopwatch()
+        with stopwatch.stage('generate'):
+            package = make_package(spec, os.path.join(work_dir, f'synthetic_{size}.apkg'))
+        result = run_one(package, work_dir, preview_count, import_count)
+        result['timings']['generate'] = stopwatch.timings['generate']
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'anki': anki_version,
+        'platform': platform.platform(),
+        'spec': base_spec._asdict(),
+        'preview_count': preview_count,
+        'import_count': import_count,
+        'results': results,
+    }
+
+
+def make_parser() -> argparse.ArgumentParser:
+    defaults = PackageSpec()
+    parser = argparse.ArgumentParser(description="Benchmark the add-on on synthetic packages.")
+    parser.add_argument('--sizes', default='1000,10000,50000', help="comma-separated note counts")
+    parser.add_argument('--note-types', type=int, default=defaults.note_types)
+    parser.add_argument('--fields', type=int, default=defaults.fields, help="fields per note type")
+    parser.add_argument('--field-words', type=int, default=defaults.field_words, help="words per field")
+    parser.add_argument('--media-files', type=int, default=defaults.media_files)
+    parser.add_argument('--media-kb', type=int, default=defaults.media_kb, help="size of each media file")
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--preview-count', type=int, default=200, help="notes to render in the previewer")
+    parser.add_argument('--import-count', type=int, default=1000, help="notes to import")
+    parser.add_argument('--output', default='benchmark.json', help="where to write the results")
+    parser.add_argument('--work-dir', help="keep generated packages here instead of a temporary folder")
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = make_parser().parse_args(argv)
+    spec = PackageSpec(
+        note_types=args.note_types,
+        fields=args.fields,
+        field_words=args.field_words,
+        media_files=args.media_files,
+        media_kb=args.media_kb,
+        seed=args.seed,
+    )
+    sizes = [int(size) for size in args.sizes.split(',')]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='cropro_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        report = run(sizes, spec, work_dir, args.preview_count, args.import_count)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
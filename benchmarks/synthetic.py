@@ -0,0 +1,143 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Generates .apkg files with random notes and media, so that benchmarks don't depend on real decks.
+The same spec always produces the same notes.
+"""
+
+import itertools
+import json
+import math
+import os
+import random
+import string
+import struct
+import tempfile
+import zipfile
+import zlib
+from typing import NamedTuple
+
+from anki.collection import Collection, AddNoteRequest
+from anki.models import NoteType
+
+ADD_BATCH_SIZE = 5_000
+
+
+class PackageSpec(NamedTuple):
+    notes: int = 10_000
+    note_types: int = 2
+    fields: int = 4
+    # Words in each field.
+    field_words: int = 12
+    # Half of the files are images, half are sounds.
+    media_files: int = 100
+    media_kb: int = 50
+    vocabulary: int = 5_000
+    seed: int = 0
+
+
+class SyntheticPackage(NamedTuple):
+    path: str
+    spec: PackageSpec
+    # Words sorted from the most to the least frequent.
+    vocabulary: list[str]
+
+    def queries(self) -> dict[str, str]:
+        """Searches of different kinds, with results of different sizes."""
+        words = self.vocabulary
+        return {
+            'common_word': words[0],
+            'rare_word': words[-1],
+            'two_words': f"{words[1]} {words[20]}",
+            'anki_syntax': f"{words[2]} -{words[3]}",
+        }
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list[str]:
+    words: dict[str, None] = {}
+    while len(words) < size:
+        words[''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))] = None
+    return list(words)
+
+
+def noise_png(rng: random.Random, size: int) -> bytes:
+    """A valid PNG image of roughly the given size. Noise doesn't compress, so the size is predictable."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    side = max(1, int(math.sqrt(size / 3)))
+    raw = b''.join(b'\x00' + rng.randbytes(side * 3) for _ in range(side))
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 1)),
+        chunk(b'IEND', b''),
+    ))
+
+
+def media_file_name(idx: int) -> str:
+    return f"synthetic_{idx:05d}.png" if idx % 2 == 0 else f"synthetic_{idx:05d}.mp3"
+
+
+def media_reference(file_name: str) -> str:
+    return f'<img src="{file_name}">' if file_name.endswith('.png') else f'[sound:{file_name}]'
+
+
+def add_note_type(col: Collection, name: str, field_count: int) -> NoteType:
+    model = col.models.new(name)
+    for idx in range(field_count):
+        col.models.add_field(model, col.models.new_field(f"Field {idx + 1}"))
+    template = col.models.new_template("Card 1")
+    template['qfmt'] = "{{Field 1}}"
+    template['afmt'] = "{{FrontSide}}<hr id=answer>" + ''.join(f"{{{{Field {idx + 1}}}}}" for idx in range(1, field_count))
+    col.models.add_template(model, template)
+    col.models.add(model)
+    return model
+
+
+def add_notes(col: Collection, spec: PackageSpec, rng: random.Random, vocabulary: list[str]) -> None:
+    models = [add_note_type(col, f"Synthetic {idx + 1}", spec.fields) for idx in range(spec.note_types)]
+    deck_id = col.decks.id("Synthetic", create=True)
+    # Word frequencies follow Zipf's law, like in natural text.
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    requests = []
+    for idx in range(spec.notes):
+        note = col.new_note(models[idx % len(models)])
+        for field_idx in range(spec.fields):
+            note.fields[field_idx] = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=spec.field_words))
+        if spec.media_files:
+            note.fields[-1] += media_reference(media_file_name(idx % spec.media_files))
+        requests.append(AddNoteRequest(note, deck_id))
+        if len(requests) >= ADD_BATCH_SIZE:
+            col.add_notes(requests)
+            requests.clear()
+    if requests:
+        col.add_notes(requests)
+
+
+def make_package(spec: PackageSpec, path: str) -> SyntheticPackage:
+    """Writes a package in the legacy format: a schema 11 collection, a "media" map and numbered media files."""
+    rng = random.Random(spec.seed)
+    vocabulary = make_vocabulary(rng, spec.vocabulary)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        col_path = os.path.join(tmp_dir, 'collection.anki2')
+        col = Collection(col_path)
+        try:
+            add_notes(col, spec, rng, vocabulary)
+        finally:
+            col.close(downgrade=True)
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            z.write(col_path, 'collection.anki2')
+            media_map = {}
+            for idx in range(spec.media_files):
+                media_map[str(idx)] = file_name = media_file_name(idx)
+                if file_name.endswith('.png'):
+                    data = noise_png(rng, spec.media_kb * 1024)
+                else:
+                    data = rng.randbytes(spec.media_kb * 1024)
+                z.writestr(str(idx), data, compress_type=zipfile.ZIP_STORED)
+            z.writestr('media', json.dumps(media_map))
+    return SyntheticPackage(path, spec, vocabulary)
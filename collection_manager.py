@@ -1,18 +1,32 @@
 # Copyright: Ren Tatsumoto <tatsu at autistici.org>
 # Copyright (c) 2023 mizmu addons 
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
-import json
+import array
 import os
+import re
+import shutil
+import threading
+import time
 import zipfile
-from typing import Optional, NamedTuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, NamedTuple, Callable, Sequence, Iterable
 
-import unicodedata
 from anki.collection import Collection
-from anki.importing.anki2 import MediaMapInvalid, Anki2Importer
-from anki.notes import NoteId
-from anki.utils import tmpfile
+from anki.notes import NoteId, Note
+from anki.utils import split_fields
 from aqt import mw
-from aqt.utils import showInfo
+
+from .apkg_file import ProgressFn, extract_collection, MediaIndex, STAGE_INDEX
+from .common import LogDebug
+from .config import config
+from .fulltext_index import FullTextIndex, plain_terms, is_fts_available, MIN_TERM_LENGTH
+from .package_cache import package_cache, CacheEntry
+from .package_reader import PackageReader
+from .perf import span
+from .workspace import workspace, WorkspaceEntry
+
+logDebug = LogDebug()
 
 
 class NameId(NamedTuple):
@@ -24,22 +38,312 @@ class NameId(NamedTuple):
         return cls('None (create new if needed)', -1)
 
 
+class NoteRow(NamedTuple):
+    """Just enough of a note to display it in the result list."""
+    id: NoteId
+    mid: int
+    mod: int
+    fields: list[str]
+
+
+class SearchCancelled(Exception):
+    """Raised by a search whose results are no longer needed, e.g. because the user kept typing."""
+
+
+# Returns True once the search that called it is outdated.
+IsCancelledFn = Callable[[], bool]
+
+
+def raise_if_cancelled(is_cancelled: Optional[IsCancelledFn]) -> None:
+    if is_cancelled is not None and is_cancelled():
+        raise SearchCancelled()
+
+
+class SourceNote(NamedTuple):
+    """A note from an opened package together with the package's media and name."""
+    note: Note
+    media: MediaIndex
+    package: str
+
+
 def sorted_decks_and_ids(col: Collection) -> list[NameId]:
     return sorted(NameId(deck.name, deck.id) for deck in col.decks.all_names_and_ids())
 
 
+def media_dir_for(col_path: str) -> str:
+    """Where Anki keeps the media of a collection, e.g. "collection.media" for "collection.anki2"."""
+    media_dir = f"{os.path.splitext(col_path)[0]}.media"
+    os.makedirs(media_dir, exist_ok=True)
+    return media_dir
+
+
+def remove_collection_files(col_path: str) -> None:
+    """Removes a collection file together with its journal files and media folder."""
+    base, _ext = os.path.splitext(col_path)
+    for path in (col_path, f"{col_path}-wal", f"{col_path}-shm", f"{base}.media.db2", f"{base}.fts.sqlite"):
+        if os.path.isfile(path):
+            os.remove(path)
+    shutil.rmtree(f"{base}.media", ignore_errors=True)
+
+
 def get_other_profile_names() -> list[str]:
     profiles = mw.pm.profiles()
     profiles.remove(mw.pm.name)
     return profiles
 
 
+def query_terms(query: str) -> list[str]:
+    """Splits a search query into terms. Quoted terms are kept together."""
+    return re.findall(r'-?"[^"]*"|\S+', query)
+
+
+class SearchCache:
+    """
+    Remembers the note ids found by recent searches in one package.
+    A query that only adds terms to a cached query is answered by filtering the cached ids.
+    """
+    _max_entries = 32
+    _max_total_ids = 2_000_000
+    # Larger id lists make the "nid:" query itself too slow to be worth it.
+    _max_refine_ids = 50_000
+
+    def __init__(self):
+        # (deck, query terms) -> note ids
+        self._entries: OrderedDict[tuple[NameId, tuple[str, ...]], array.array] = OrderedDict()
+        # Searches run on background threads.
+        self._lock = threading.Lock()
+        self.hits = self.refinements = self.misses = 0
+
+    def find_notes(
+            self,
+            deck: NameId,
+            filter_text: str,
+            search: Callable[[str], Sequence[NoteId]],
+            refine: Callable[[Sequence[NoteId], list[str]], Sequence[NoteId]],
+    ) -> Sequence[NoteId]:
+        terms = tuple(query_terms(filter_text))
+        key = (deck, terms)
+        with self._lock:
+            if (note_ids := self._entries.get(key)) is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            base = None if note_ids is not None else self._narrowest_base(deck, terms)
+        if note_ids is not None:
+            result = note_ids
+        elif base is not None:
+            base_ids, extra_terms = base
+            with span('refine_cached', cached_notes=len(base_ids)):
+                result = array.array('q', refine(base_ids, extra_terms) if base_ids else ())
+        else:
+            result = array.array('q', search(filter_text))
+        with self._lock:
+            if note_ids is None:
+                if base is not None:
+                    self.refinements += 1
+                else:
+                    self.misses += 1
+            self._store(key, result)
+            logDebug(f"search cache: {self.hits} hits, {self.refinements} refinements, {self.misses} misses.")
+        return result
+
+    def _narrowest_base(self, deck: NameId, terms: tuple[str, ...]) -> Optional[tuple[array.array, list[str]]]:
+        """Finds the cached search with the fewest results whose terms are all contained in the new query."""
+        if any(term.lower() == 'or' for term in terms):
+            # Adding terms to a query with top-level "or" doesn't necessarily narrow it.
+            return None
+        best = None
+        for (cached_deck, cached_terms), note_ids in self._entries.items():
+            if cached_deck != deck or len(note_ids) > self._max_refine_ids:
+                continue
+            if not cached_terms or len(cached_terms) >= len(terms):
+                continue
+            remaining = list(terms)
+            try:
+                for term in cached_terms:
+                    remaining.remove(term)
+            except ValueError:
+                continue
+            if best is None or len(note_ids) < len(best[0]):
+                best = (note_ids, remaining)
+        return best
+
+    def _store(self, key: tuple[NameId, tuple[str, ...]], note_ids: array.array) -> None:
+        self._entries[key] = note_ids
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries or (
+                len(self._entries) > 1 and sum(map(len, self._entries.values())) > self._max_total_ids
+        ):
+            self._entries.popitem(last=False)
+
+
+class OpenedPackage:
+    """
+    A package whose collection is open. Search results keep a reference to the package they came from.
+    Browsing only reads the collection file with PackageReader.
+    The full Collection is opened on first use, i.e. for imports and searches that use Anki syntax.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            col_path: str,
+            reader: PackageReader,
+            media: MediaIndex,
+            cache_entry: Optional[CacheEntry],
+            fts: Optional[FullTextIndex] = None,
+            workspace_entry: Optional[WorkspaceEntry] = None,
+    ):
+        self.name = name
+        self.reader = reader
+        self.media = media
+        self._col_path = col_path
+        self._col: Optional[Collection] = None
+        self._col_lock = threading.Lock()
+        self._cache_entry = cache_entry
+        self._workspace_entry = workspace_entry
+        self._fts = fts
+        self._search_cache = SearchCache()
+
+    @property
+    def col(self) -> Collection:
+        with self._col_lock:
+            if self._col is None:
+                with span('open_collection'):
+                    self._col = self.reader.hand_over(lambda: Collection(self._col_path))
+            return self._col
+
+    def close(self) -> None:
+        # The reader may be using the Collection's connection.
+        self.reader.close()
+        with self._col_lock:
+            if self._col is not None:
+                self._col.close()
+        self.media.close()
+        if self._fts:
+            self._fts.close()
+        if self._cache_entry:
+            package_cache.release(self._cache_entry)
+        if self._workspace_entry:
+            workspace.remove(self._workspace_entry)
+
+    @property
+    def uses_workspace(self) -> bool:
+        return self._workspace_entry is not None
+
+    def deck_names_and_ids(self) -> list[NameId]:
+        return sorted(NameId(name, deck_id) for name, deck_id in self.reader.deck_names_and_ids())
+
+    def find_notes(
+            self,
+            deck: NameId,
+            filter_text: str,
+            is_cancelled: Optional[IsCancelledFn] = None,
+    ) -> Sequence[NoteId]:
+        """
+        is_cancelled is checked before every expensive step.
+        If it returns True, SearchCancelled is raised and nothing is cached.
+        """
+        with span('find_notes') as search_span:
+            note_ids = self._search_cache.find_notes(
+                deck,
+                filter_text,
+                search=lambda text: self._search(deck, text, is_cancelled),
+                refine=lambda base_ids, extra_terms: self._refine(base_ids, extra_terms, is_cancelled),
+            )
+            search_span.count(notes=len(note_ids))
+        return note_ids
+
+    def _search(self, deck: NameId, filter_text: str, is_cancelled: Optional[IsCancelledFn]) -> Sequence[NoteId]:
+        raise_if_cancelled(is_cancelled)
+        if not filter_text.strip():
+            with span('list_all'):
+                note_ids = self.reader.all_note_ids()
+                raise_if_cancelled(is_cancelled)
+                return self._in_deck(deck, note_ids)
+        if terms := plain_terms(filter_text, min_length=1):
+            with span('plain_search'):
+                note_ids = self._plain_search(terms)
+                raise_if_cancelled(is_cancelled)
+                return self._in_deck(deck, note_ids)
+        with span('anki_search'):
+            # Opening the full Collection for the first time takes a while.
+            col = self.col
+            raise_if_cancelled(is_cancelled)
+            if deck == CollectionManager.col_name_and_id():
+                return col.find_notes(query=filter_text)
+            else:
+                return col.find_notes(query=f'"deck:{deck.name}" {filter_text}')
+
+    def _plain_search(self, terms: list[str], within: Optional[Sequence[NoteId]] = None) -> Sequence[NoteId]:
+        """
+        Uses the full-text index if there is one and it can match the terms.
+        Otherwise scans the notes, only those within the given ids if there are any.
+        """
+        if self._fts and all(len(term) >= MIN_TERM_LENGTH for term in terms):
+            note_ids = self._fts.search(terms)
+            if within is not None:
+                within = set(within)
+                note_ids = [nid for nid in note_ids if nid in within]
+            return note_ids
+        return self.reader.search_plain(terms, within=within)
+
+    def _refine(
+            self,
+            base_ids: Sequence[NoteId],
+            extra_terms: list[str],
+            is_cancelled: Optional[IsCancelledFn],
+    ) -> Sequence[NoteId]:
+        """Narrows down the results of a cached search. The base results are already limited to the deck."""
+        raise_if_cancelled(is_cancelled)
+        if terms := plain_terms(' '.join(extra_terms), min_length=1):
+            return self._plain_search(terms, within=base_ids)
+        col = self.col
+        raise_if_cancelled(is_cancelled)
+        return col.find_notes(query=f"nid:{','.join(map(str, base_ids))} {' '.join(extra_terms)}")
+
+    def _in_deck(self, deck: NameId, note_ids: Sequence[NoteId]) -> Sequence[NoteId]:
+        if deck == CollectionManager.col_name_and_id():
+            return note_ids
+        in_deck = self.reader.note_ids_in_decks(self.reader.deck_and_child_ids(deck.id))
+        return [nid for nid in note_ids if nid in in_deck]
+
+    def get_note(self, note_id: NoteId) -> Note:
+        return self.col.get_note(note_id)
+
+    def get_source_note(self, note_id: NoteId) -> SourceNote:
+        return SourceNote(self.get_note(note_id), self.media, self.name)
+
+    def note_ids_by_guid(self, guids: Iterable[str]) -> set[NoteId]:
+        return self.reader.note_ids_by_guid(guids)
+
+    def field_names(self, mid: int) -> list[str]:
+        return self.reader.field_names(mid)
+
+    def note_type_mod(self, mid: int) -> int:
+        return self.reader.note_type_mod(mid)
+
+    def fetch_rows(self, note_ids: Sequence[NoteId]) -> list[NoteRow]:
+        """
+        Reads the rows of a page of results in one query, without constructing Note objects.
+        Rows are returned in the order of note_ids.
+        """
+        rows = {
+            nid: NoteRow(nid, mid, mod, split_fields(flds))
+            for nid, mid, mod, flds in self.reader.fetch_notes(note_ids)
+        }
+        return [rows[nid] for nid in note_ids if nid in rows]
+
+
 class CollectionManager:
     """This class keeps other collections (profiles) open and can switch between them."""
 
     def __init__(self):
-        self._opened_cols: dict[str, Collection] = {}
+        # Least recently used first.
+        self._opened: OrderedDict[str, OpenedPackage] = OrderedDict()
         self._current_name: Optional[str] = None
+        # Packages may be opened from several threads at once, but each package only once.
+        self._locks_lock = threading.Lock()
+        self._open_locks: dict[str, threading.Lock] = {}
 
     @property
     def name(self) -> Optional[str]:
@@ -47,13 +351,21 @@ class CollectionManager:
             raise RuntimeError("Collection vanished or was never opened.")
         return self._current_name
 
+    @property
+    def package(self) -> OpenedPackage:
+        return self._opened[self.name]
+
     @property
     def col(self):
-        return self._opened_cols[self.name]
+        return self.package.col
+
+    @property
+    def media(self) -> MediaIndex:
+        return self.package.media
 
     @property
     def media_dir(self):
-        return self.col.media.dir()
+        return self.media.dir
 
     @staticmethod
     def col_name_and_id() -> NameId:
@@ -61,67 +373,194 @@ class CollectionManager:
 
     @property
     def is_opened(self) -> bool:
-        return True
+        return self._current_name is not None
+
+    def has_opened(self, name: str) -> bool:
+        return name in self._opened
 
     def close(self):
         if self.is_opened:
-            self._opened_cols.pop(self._current_name).close()
+            self.close_one(self._current_name)
+
+    def close_one(self, name: str):
+        if package := self._opened.pop(name, None):
+            package.close()
+        if name == self._current_name:
             self._current_name = None
 
     def close_all(self):
-        for col in self._opened_cols.values():
-            col.close()
+        for package in self._opened.values():
+            package.close()
         self._current_name = None
-        self._opened_cols.clear()
+        self._opened.clear()
 
-    def open(self, name: str) -> None:
-        if name not in self._opened_cols:
-            zip = z = zipfile.ZipFile(name)
-            # v2 scheduler?
-            try:
-                z.getinfo("collection.anki21")
-                suffix = ".anki21"
-            except KeyError:
-                suffix = ".anki2"
-
-            col = z.read(f"collection{suffix}")
-            colpath = tmpfile(suffix=".anki2")
-            with open(colpath, "wb") as f:
-                f.write(col)
-            self._current_name = name
-            self._opened_cols[self.name] = Collection(colpath)
-            dir = self.col.media.dir()
-
-            self.nameToNum = {}
+    def open(self, name: str, progress: Optional[ProgressFn] = None) -> None:
+        """
+        Extracts the package, opens its collection and makes it the current one.
+        If progress raises (e.g. the user cancelled), partially extracted files are removed.
+        """
+        self.open_package(name, progress)
+        # The previous package may still be on screen until the new one replaces it.
+        self._enforce_quota(keep={name, self._current_name})
+        self._current_name = name
+
+    def open_package(self, name: str, progress: Optional[ProgressFn] = None) -> OpenedPackage:
+        """Like open(), but leaves the current package alone. Different packages can be opened in parallel."""
+        with self._locks_lock:
+            open_lock = self._open_locks.setdefault(name, threading.Lock())
+        with open_lock:
+            return self._open_package(name, progress)
+
+    def _open_package(self, name: str, progress: Optional[ProgressFn]) -> OpenedPackage:
+        if name in self._opened:
+            self._opened.move_to_end(name)
+            return self._opened[name]
+        with span('open_package', package_bytes=os.path.getsize(name)) as open_span:
+            if progress:
+                progress(STAGE_INDEX, 0, 0)
+            z = zipfile.ZipFile(name)
+            # If the package has been seen before, reuse the extracted collection and media.
+            entry = package_cache.acquire(name)
+            # Otherwise extract it into a temporary folder that is removed when the package is closed.
+            work = None if entry else workspace.create(name)
+            colpath = entry.col_path if entry else work.col_path
+            reader = fts = None
             try:
-                media_dict = json.loads(z.read("media").decode("utf8"))
-            except Exception as exc:
-                raise MediaMapInvalid() from exc
-            for k, v in list(media_dict.items()):
-                path = os.path.abspath(os.path.join(dir, v))
-                if os.path.commonprefix([path, dir]) != dir:
-                    raise Exception("Invalid file")
-
-                self.nameToNum[unicodedata.normalize("NFC", v)] = k
-
-            for file, c in list(self.nameToNum.items()):
-                path = os.path.join(self.col.media.dir(), file)
-                if not os.path.exists(path):
-                    # print(path)
-                    with open(path, "wb") as f:
-                        f.write(z.read(c))
-            self.file = colpath
+                if entry and entry.ready:
+                    open_span.count(cache_hits=1)
+                else:
+                    with span('extract_collection') as extract_span:
+                        extract_collection(z, colpath, progress=progress)
+                        extract_span.count(bytes=os.path.getsize(colpath))
+                with span('open_reader'):
+                    reader = PackageReader(colpath)
+                media = MediaIndex(z, media_dir_for(colpath))
+                open_span.count(media_files=len(media))
+                if not config['lazy_media_extraction']:
+                    with span('extract_media', files=len(media)):
+                        media.extract_all(progress=progress)
+                if config['fulltext_index'] and is_fts_available():
+                    with span('fulltext_index'):
+                        fts = FullTextIndex(colpath)
+                        # Cached packages are keyed by their fingerprint, so checking the notes again isn't needed.
+                        fts.ensure_built(reader, progress=progress, signature=entry.key if entry else None)
+                if entry and not entry.ready:
+                    with span('cache_store'):
+                        entry = package_cache.mark_ready(entry, name)
+            except BaseException:
+                if fts:
+                    fts.close()
+                if reader:
+                    reader.close()
+                z.close()
+                if entry:
+                    package_cache.release(entry)
+                else:
+                    workspace.remove(work)
+                raise
+            self._opened[name] = OpenedPackage(name, colpath, reader, media, entry, fts, work)
+        return self._opened[name]
 
-        self._current_name = name
+    def search_packages(
+            self,
+            names: Sequence[str],
+            filter_text: str,
+            is_cancelled: Optional[IsCancelledFn] = None,
+    ) -> list[tuple[OpenedPackage, Sequence[NoteId]]]:
+        """
+        Opens (or reuses) every package and searches them in parallel.
+        Results are returned in the order of names.
+        """
+
+        def search(name: str) -> tuple[OpenedPackage, Sequence[NoteId]]:
+            raise_if_cancelled(is_cancelled)
+            package = self.open_package(name)
+            return package, package.find_notes(self.col_name_and_id(), filter_text, is_cancelled)
+
+        with ThreadPoolExecutor(max_workers=min(len(names), os.cpu_count() or 1) or 1) as executor:
+            results = list(executor.map(search, names))
+        self._enforce_quota(keep=set(names))
+        return results
+
+    def _enforce_quota(self, keep: set[Optional[str]]) -> None:
+        """Closes the least recently used packages that were extracted into the workspace until it fits the quota."""
+        for name in list(self._opened):
+            if not workspace.is_over_quota():
+                break
+            if name in keep or not self._opened[name].uses_workspace:
+                continue
+            logDebug(f"closing {name} to free up workspace space.")
+            self.close_one(name)
 
     def deck_names_and_ids(self) -> list[NameId]:
-        return sorted_decks_and_ids(self.col)
+        return self.package.deck_names_and_ids()
 
-    def find_notes(self, deck: NameId, filter_text: str):
-        if deck == self.col_name_and_id():
-            return self.col.find_notes(query=filter_text)
-        else:
-            return self.col.find_notes(query=f'"deck:{deck.name}" {filter_text}')
+    def find_notes(self, deck: NameId, filter_text: str) -> Sequence[NoteId]:
+        return self.package.find_notes(deck, filter_text)
 
-    def get_note(self, note_id: NoteId):
-        return self.col.get_note(note_id)
+    def get_note(self, note_id: NoteId) -> Note:
+        return self.package.get_note(note_id)
+
+    def get_source_note(self, note_id: NoteId) -> SourceNote:
+        return self.package.get_source_note(note_id)
+
+
+class OpenCancelled(Exception):
+    pass
+
+
+class OpenPackageTask:
+    """
+    Opens a package on a background thread.
+    Progress is reported on the main thread.
+    """
+
+    # Don't flood the main thread with progress updates.
+    _progress_interval = 0.1
+
+    def __init__(
+            self,
+            manager: CollectionManager,
+            name: str,
+            on_progress: ProgressFn,
+            on_done: Callable[[Optional[Exception]], None],
+    ):
+        self._manager = manager
+        self._name = name
+        self._on_progress = on_progress
+        self._on_done = on_done
+        self._cancel_event = threading.Event()
+        self._last_stage: Optional[str] = None
+        self._last_report = 0.0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def start(self) -> None:
+        mw.taskman.run_in_background(
+            lambda: self._manager.open(self._name, progress=self._progress),
+            self._finished,
+        )
+
+    def cancel(self) -> None:
+        self._cancel_event.set()
+
+    def _progress(self, stage: str, done: int, total: int) -> None:
+        # Called on the background thread.
+        if self.cancelled:
+            raise OpenCancelled()
+        now = time.monotonic()
+        if stage != self._last_stage or now - self._last_report >= self._progress_interval or done == total:
+            self._last_stage, self._last_report = stage, now
+            mw.taskman.run_on_main(lambda: self._on_progress(stage, done, total))
+
+    def _finished(self, future) -> None:
+        if self.cancelled and future.exception() is None:
+            # The package was opened after the user gave up on it.
+            self._manager.close_one(self._name)
+        self._on_done(None if self.cancelled else future.exception())
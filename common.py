@@ -1,44 +1,173 @@
 # Copyright: Ren Tatsumoto <tatsu at autistici.org>
-# Copyright (c) 2023 mizmu addons 
+# Copyright (c) 2023 mizmu addons
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+import atexit
+import enum
 import os
-from typing import Optional, TextIO
+import queue
+import sys
+import threading
+import time
+from typing import Optional, TextIO, NamedTuple
 
 from aqt import mw, gui_hooks
 
-from .config import config
+from .config import config, ADDON_DIR
 
 ADDON_NAME = 'Partial import from apkg file'
+LOG_FILE_NAME = 'cropro.log'
+
+
+def log_dir() -> str:
+    """Anki's base folder, or the add-on's user_files folder outside of Anki."""
+    return mw.pm.base if mw is not None else os.path.join(ADDON_DIR, 'user_files')
+
+
+class LogLevel(enum.IntEnum):
+    debug = 10
+    info = 20
+    warning = 30
+    error = 40
+
+    @classmethod
+    def from_config(cls) -> 'LogLevel':
+        try:
+            return cls[str(config.get('log_level', 'debug')).lower()]
+        except KeyError:
+            return cls.debug
+
+
+class AppendLine(NamedTuple):
+    """A line for a file other than the log, e.g. the trace file, written by the same thread."""
+    path: str
+    line: str
 
 
 class LogDebug:
-    _logfile: Optional[TextIO] = None
+    """
+    Queues messages and writes them on a background thread, so that logging never blocks the caller.
+    The log file is flushed once per batch and rotated when it grows too large.
+    Warnings and errors are printed even if the debug log is disabled.
+    """
+    # Messages that arrive within this interval are written together.
+    _batch_interval = 0.2
+    _max_batch = 500
+    _max_file_size = 5 * 1024 * 1024
+    # cropro.log.1, cropro.log.2
+    _backup_count = 2
+    _stop = object()
     _instance = None
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
-            cls._instance = super().__new__(cls, *args, **kwargs)
+            cls._instance = self = super().__new__(cls, *args, **kwargs)
+            self._queue = queue.SimpleQueue()
+            self._lock = threading.Lock()
+            self._writer: Optional[threading.Thread] = None
+            self._logfile: Optional[TextIO] = None
+            gui_hooks.profile_will_close.append(self.close)
+            atexit.register(self.close)
         return cls._instance
 
-    def __init__(self):
-        gui_hooks.profile_will_close.append(self.close)
-
-    def write(self, msg: str) -> None:
-        print('CroPro debug:', str(msg))
-        if not config['enable_debug_log']:
+    def write(self, msg: str, level: LogLevel = LogLevel.debug) -> None:
+        if level < LogLevel.warning and (not config['enable_debug_log'] or level < LogLevel.from_config()):
             return
-        if not self._logfile:
-            path = os.path.join(mw.pm.base, 'cropro.log')
-            print(f'CroPro debug: opening log file "{path}"')
-            self._logfile = open(path, 'a')
-        self._logfile.write(str(msg) + '\n')
-        self._logfile.flush()
+        self._queue.put((time.time(), level, str(msg)))
+        self._ensure_writer()
 
     def __call__(self, *args, **kwargs):
         return self.write(*args, **kwargs)
 
+    def append_line(self, path: str, line: str) -> None:
+        """Appends a line to a file on the writer thread. Doesn't depend on the log settings."""
+        self._queue.put(AppendLine(path, line))
+        self._ensure_writer()
+
+    def info(self, msg: str) -> None:
+        self.write(msg, LogLevel.info)
+
+    def warning(self, msg: str) -> None:
+        self.write(msg, LogLevel.warning)
+
+    def error(self, msg: str) -> None:
+        self.write(msg, LogLevel.error)
+
     def close(self):
+        """Writes out the queued messages and closes the log file. Logging again reopens it."""
+        with self._lock:
+            writer = self._writer
+        if writer and writer.is_alive():
+            self.info("closing debug log.")
+            self._queue.put(self._stop)
+            writer.join(timeout=5)
+
+    def _ensure_writer(self) -> None:
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._run, name='cropro-log-writer', daemon=True)
+                self._writer.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._batch_interval
+            while len(batch) < self._max_batch and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = any(item is self._stop for item in batch)
+            self._append_lines([item for item in batch if isinstance(item, AppendLine)])
+            self._write_batch([item for item in batch if item is not self._stop and not isinstance(item, AppendLine)])
+            if stop:
+                self._close_file()
+                return
+
+    def _write_batch(self, batch: list[tuple[float, LogLevel, str]]) -> None:
+        if not batch:
+            return
+        lines = [
+            f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))} {level.name.upper()} {msg}\n"
+            for timestamp, level, msg in batch
+        ]
+        sys.stderr.write(''.join(f"CroPro {level.name}: {msg}\n" for _timestamp, level, msg in batch))
+        if not config['enable_debug_log']:
+            return
+        try:
+            if not self._logfile:
+                self._logfile = open(os.path.join(log_dir(), LOG_FILE_NAME), 'a', encoding='utf8')
+            self._logfile.write(''.join(lines))
+            self._logfile.flush()
+            if self._logfile.tell() > self._max_file_size:
+                self._rotate()
+        except OSError as ex:
+            sys.stderr.write(f"CroPro: can't write the debug log: {ex}\n")
+            self._close_file()
+
+    @staticmethod
+    def _append_lines(items: list[AppendLine]) -> None:
+        by_path: dict[str, list[str]] = {}
+        for item in items:
+            by_path.setdefault(item.path, []).append(item.line)
+        for path, lines in by_path.items():
+            try:
+                with open(path, 'a', encoding='utf8') as f:
+                    f.write(''.join(f"{line}\n" for line in lines))
+            except OSError as ex:
+                sys.stderr.write(f"CroPro: can't write {path}: {ex}\n")
+
+    def _rotate(self) -> None:
+        self._close_file()
+        path = os.path.join(log_dir(), LOG_FILE_NAME)
+        for idx in range(self._backup_count, 0, -1):
+            source = f"{path}.{idx - 1}" if idx > 1 else path
+            if os.path.isfile(source):
+                os.replace(source, f"{path}.{idx}")
+
+    def _close_file(self) -> None:
         if self._logfile and not self._logfile.closed:
-            self.write("closing debug log.")
-            self._logfile = self._logfile.close()
+            self._logfile.close()
+        self._logfile = None
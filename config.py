@@ -2,14 +2,38 @@
 # Copyright (c) 2023 mizmu addons 
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+import json
+import os
+
 from aqt import mw
 
+ADDON_DIR = os.path.dirname(__file__)
+
+
+def read_config_files() -> dict:
+    """
+    Reads the config without Anki's add-on manager, e.g. when the add-on is used from the command line.
+    User changes saved by Anki in meta.json take precedence over the defaults.
+    """
+    with open(os.path.join(ADDON_DIR, 'config.json'), encoding='utf8') as f:
+        result = json.load(f)
+    try:
+        with open(os.path.join(ADDON_DIR, 'meta.json'), encoding='utf8') as f:
+            result.update(json.load(f).get('config', {}))
+    except (OSError, ValueError):
+        pass
+    return result
+
 
 def get_config():
+    if mw is None:
+        return read_config_files()
     return mw.addonManager.getConfig(__name__)
 
 
 def write_config():
+    if mw is None:
+        return
     return mw.addonManager.writeConfig(__name__, config)
 
 
@@ -9,29 +9,41 @@ Original concept by CalculusAce, with help from Matt VS Japan (@mattvsjapan)
 
 TODO:
 - Handle case where user has only one profile
-- Review duplicate checking: check by first field, or all fields?
-- When matching model is found, verify field count (or entire map?)
 """
 
 import json
 import os.path
+import time
 from collections import defaultdict
+from concurrent.futures import Future
+from typing import Optional, Sequence
+
+from anki.notes import NoteId
 
 from aqt import mw, gui_hooks
+from aqt.operations import CollectionOp
 from aqt.operations.deck import add_deck_dialog
 from aqt.qt import *
 from aqt.utils import showInfo, disable_help_button, restoreGeom, saveGeom, getFile
 
 # from .ajt_common.about_menu import menu_root_entry
-from .collection_manager import CollectionManager, sorted_decks_and_ids, NameId
+from .collection_manager import CollectionManager, sorted_decks_and_ids, NameId, OpenPackageTask, OpenCancelled, \
+    OpenedPackage, IsCancelledFn, raise_if_cancelled
 from .common import ADDON_NAME, LogDebug
 from .config import config
-from .note_importer import import_note, ImportResult
-from .settings_dialog import CroProSettingsDialog
-from .widgets import SearchResultLabel, DeckCombo, ComboBox, ProfileNameLabel, StatusBar, NoteList, WIDGET_HEIGHT
+from .import_ledger import ledger
+from .note_importer import NoteImporter, ImportSummary, ImportResult
+from .perf import span
+from .settings_dialog import CroProSettingsDialog, disk_usage_text
+from .widgets import SearchResultLabel, DeckCombo, ComboBox, ProfileNameLabel, StatusBar, NoteList, WIDGET_HEIGHT, \
+    OpenProgress
+from .workspace import workspace
 
 logDebug = LogDebug()
 
+# How long to wait after the last keystroke before searching.
+SEARCH_DEBOUNCE_MS = 300
+
 # class search_edit(QLineEdit):
 #     def __init__(self):
 #         super().__init__()
@@ -64,6 +76,7 @@ class MainDialogUI(QDialog):
         self.get_apkg_button = QPushButton('choose file...')
         # self.other_profile_names_combo = ComboBox()
         self.other_profile_deck_combo = DeckCombo()
+        self.open_progress = OpenProgress()
         self.filter_button = QPushButton('Filter')
         self.filter_button.setFocus()
         self.note_list = NoteList()
@@ -85,6 +98,7 @@ class MainDialogUI(QDialog):
     def make_main_layout(self) -> QLayout:
         main_vbox = QVBoxLayout()
         main_vbox.addLayout(self.make_other_profile_settings_box())
+        main_vbox.addWidget(self.open_progress)
         main_vbox.addLayout(self.make_filter_row())
         main_vbox.addWidget(self.search_result_label)
         main_vbox.addWidget(self.note_list)
@@ -167,32 +181,76 @@ class WindowState:
             return False
 
     def restore(self):
-        if self._load() and (profile_settings := self._state.get(mw.pm.name)):
-            for key, widget in self._map.items():
-                if (value := profile_settings[key]) in widget.all_items():
-                    widget.setCurrentText(value)
+        for key in self._map:
+            self.restore_widget(key)
         restoreGeom(self._window, self._window.name, adjustSize=True)
 
+    def restore_widget(self, key: str):
+        if self._load() and (profile_settings := self._state.get(mw.pm.name)):
+            widget = self._map[key]
+            if (value := profile_settings[key]) in widget.all_items():
+                widget.setCurrentText(value)
+
+
+def search_latency_ms(started: float) -> int:
+    """Time from starting a search on a background thread to showing its results."""
+    return int((time.perf_counter() - started) * 1000)
+
+
+def limit_displayed(note_ids: Sequence[NoteId]) -> Sequence[NoteId]:
+    """Applies max_displayed_notes. Zero means no limit."""
+    if limit := config['max_displayed_notes']:
+        return note_ids[:limit]
+    return note_ids
+
+
+def check_imported(
+        package: OpenedPackage,
+        note_ids: Sequence[NoteId],
+        is_cancelled: Optional[IsCancelledFn] = None,
+) -> tuple[Sequence[NoteId], set[NoteId]]:
+    """
+    Finds the notes of the package that were imported into the current profile before.
+    Returns the search results, without those notes if they are hidden, and the imported notes.
+    """
+    raise_if_cancelled(is_cancelled)
+    with span('check_imported') as check_span:
+        imported = package.note_ids_by_guid(ledger.imported_guids(package.name, mw.col))
+        check_span.count(imported=len(imported))
+        if imported and config['hide_imported_notes']:
+            note_ids = [nid for nid in note_ids if nid not in imported]
+    return note_ids, imported
+
 
 class MainDialog(MainDialogUI):
     def __init__(self, current_col="", col_list=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.current_col:str = current_col
         self.col_list = col_list
-        self.col_dict = {}
+        # Packages of col_list stay open between searches.
+        self.package_pool = CollectionManager()
         self.window_state = WindowState(self)
         self.other_col = CollectionManager()
+        self._open_task: Optional[OpenPackageTask] = None
+        # Incremented on every search. Results of older searches are dropped.
+        self._search_generation = 0
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(SEARCH_DEBOUNCE_MS)
         self.connect_elements()
         disable_help_button(self)
 
     def connect_elements(self):
         qconnect(self.get_apkg_button.clicked, self.get_apkg)
+        qconnect(self.open_progress.cancel_button.clicked, self.on_cancel_open)
         qconnect(self.settings_button.clicked, self.on_open_settings)
         qconnect(self.import_button.clicked, self.do_import)
         qconnect(self.filter_button.clicked, self.update_notes_list)
         qconnect(self.new_deck_button.clicked, self.on_new_deck)
         qconnect(self.search_term_edit.editingFinished, self.update_notes_list)
         qconnect(self.other_profile_deck_combo.currentIndexChanged, self.update_notes_list)
+        qconnect(self.search_term_edit.textChanged, self.on_search_text_changed)
+        qconnect(self._search_timer.timeout, self.on_search_timeout)
 
     def show(self):
         super().show()
@@ -204,9 +262,7 @@ class MainDialog(MainDialogUI):
             self.settings_button.setEnabled(False)
             self.update_notes_list()
         else:
-            self.get_apkg_button.setText(self.current_col.split("\\")[-1])
-            self.other_col.open(self.current_col)
-            self.populate_other_profile_decks()
+            self.open_apkg()
         self.populate_ui()
         self.search_term_edit.setFocus()
 
@@ -246,11 +302,55 @@ class MainDialog(MainDialogUI):
 
 
     def open_apkg(self):
+        """Opens the chosen package on a background thread. The deck combo is filled when it's done."""
         col_name = self.current_col
-        if not self.other_col.is_opened or col_name != self.other_col.name:
-            self.get_apkg_button.setText(col_name.split("\\")[-1])
+        if self.other_col.is_opened and col_name == self.other_col.name:
+            return
+        if self._open_task and self._open_task.name == col_name:
+            return
+        self.cancel_open_apkg()
+        self.get_apkg_button.setText(col_name.split("\\")[-1])
+        if self.other_col.has_opened(col_name):
+            # Opened earlier in this session, just switch to it.
             self.other_col.open(col_name)
             self.populate_other_profile_decks()
+            return
+        self.other_profile_deck_combo.clear()
+        self._open_task = task = OpenPackageTask(
+            manager=self.other_col,
+            name=col_name,
+            on_progress=self.open_progress.set_progress,
+            on_done=lambda exc: self._on_apkg_opened(task, exc),
+        )
+        self.open_progress.start()
+        task.start()
+
+    def _on_apkg_opened(self, task: OpenPackageTask, exc: Optional[Exception]):
+        if task is not self._open_task:
+            # Cancelled or superseded by another package.
+            return
+        self._open_task = None
+        self.open_progress.hide()
+        if exc is not None:
+            if not isinstance(exc, OpenCancelled):
+                showInfo(f"error: {exc}")
+            return
+        self.populate_other_profile_decks()
+        self.window_state.restore_widget("from_deck")
+
+    def cancel_open_apkg(self):
+        """Stops opening a package. Partially extracted files are removed by the background task."""
+        if task := self._open_task:
+            logDebug(f"cancelling opening {task.name}")
+            self._open_task = None
+            task.cancel()
+            self.open_progress.hide()
+            self.get_apkg_button.setText('choose file...')
+
+    def on_cancel_open(self):
+        self.cancel_open_apkg()
+        # Otherwise the next search would start opening the package again.
+        self.current_col = ""
 
     def populate_current_profile_decks(self):
         logDebug("populating current profile decks...")
@@ -263,10 +363,29 @@ class MainDialog(MainDialogUI):
         ])
 
     def update_notes_list(self):
+        with span('update_notes_list'):
+            self._update_notes_list()
+
+    def on_search_timeout(self):
+        with span('update_notes_list'):
+            self._update_notes_list(typed=True)
+
+    def _update_notes_list(self, typed: bool = False):
+        """typed is set for searches started while typing, whose query may be unfinished."""
         self.search_term_edit.setFocus()
         self.search_result_label.hide()
+        # Any search still running is outdated now.
+        self._search_generation += 1
 
         if self.col_list is None:
+            if not self.current_col:
+                return
+
+            if not self.other_col.has_opened(self.current_col):
+                # The deck combo will trigger the search once the package is open.
+                self.open_apkg()
+                return
+
             self.open_apkg()
 
             if not self.search_term_edit.text() and not config['allow_empty_search']:
@@ -274,72 +393,177 @@ class MainDialog(MainDialogUI):
 
             if self.other_profile_deck_combo.count() < 1:
                 return
-            try:
-                note_ids = self.other_col.find_notes(self.other_profile_deck_combo.current_deck(), self.search_term_edit.text())
-                limited_note_ids = note_ids[:config['max_displayed_notes']]
-
-                self.note_list.set_notes(
-                    map(self.other_col.get_note, limited_note_ids),
+            self.start_search(
+                self.other_col.package,
+                self.other_profile_deck_combo.current_deck(),
+                self.search_term_edit.text(),
+                typed,
+            )
+        else:
+            self.start_pooled_search(self.search_term_edit.text(), typed)
+
+    def on_search_text_changed(self):
+        if config['search_as_you_type']:
+            # Restart the countdown on every keystroke.
+            self._search_timer.start()
+
+    def _is_outdated_fn(self, generation: int) -> IsCancelledFn:
+        """
+        Lets a search on a background thread stop early once a newer search has started.
+        Outdated searches raise SearchCancelled, and their results are dropped anyway.
+        """
+        return lambda: generation != self._search_generation
+
+    def start_search(self, package: OpenedPackage, deck: NameId, text: str, typed: bool = False):
+        """Runs the search on a background thread. Only the results of the latest search are shown."""
+        self._search_timer.stop()
+        generation = self._search_generation
+        started = time.perf_counter()
+        is_cancelled = self._is_outdated_fn(generation)
+        self.search_result_label.set_searching()
+        mw.taskman.run_in_background(
+            lambda: check_imported(package, package.find_notes(deck, text, is_cancelled), is_cancelled),
+            lambda future: self._on_search_finished(generation, package, future, started, typed),
+        )
+
+    def _on_search_finished(
+            self,
+            generation: int,
+            package: OpenedPackage,
+            future: Future,
+            started: float,
+            typed: bool,
+    ):
+        if generation != self._search_generation:
+            logDebug('dropped results of a stale search.')
+            return
+        try:
+            note_ids, imported = future.result()
+        except Exception as e:
+            self._show_search_error(e, typed)
+            return
+        limited_note_ids = limit_displayed(note_ids)
+        with span('show_results', found=len(note_ids), displayed=len(limited_note_ids)) as show_span:
+            # Rows are added to the view in pages as the user scrolls.
+            self.note_list.set_notes(
+                package,
+                limited_note_ids,
+                hide_fields=config['hidden_fields'],
+                previewer=config['preview_on_right_side'],
+                imported=imported,
+            )
+            self.search_result_label.set_count(len(note_ids), len(limited_note_ids))
+            show_span.count(latency_ms=search_latency_ms(started))
+
+    def start_pooled_search(self, text: str, typed: bool = False):
+        """Searches all packages of col_list in parallel on a background thread."""
+        generation = self._search_generation
+        started = time.perf_counter()
+        is_cancelled = self._is_outdated_fn(generation)
+        names = [col_path.replace("/", "\\") for col_path in self.col_list]
+        self.search_result_label.set_searching()
+        mw.taskman.run_in_background(
+            lambda: [
+                (package, *check_imported(package, note_ids, is_cancelled))
+                for package, note_ids in self.package_pool.search_packages(names, text, is_cancelled)
+            ],
+            lambda future: self._on_pooled_search_finished(generation, future, started, typed),
+        )
+
+    def _on_pooled_search_finished(self, generation: int, future: Future, started: float, typed: bool):
+        if generation != self._search_generation:
+            logDebug('dropped results of a stale search.')
+            return
+        try:
+            results = future.result()
+        except Exception as e:
+            self._show_search_error(e, typed)
+            return
+        with span('show_results', packages=len(results)) as show_span:
+            self.note_list.clear()
+            found = displayed = 0
+            limit = config['max_displayed_notes']
+            for package, note_ids, imported in results:
+                found += len(note_ids)
+                if limit:
+                    note_ids = note_ids[:max(0, limit - displayed)]
+                displayed += len(note_ids)
+                self.note_list.add_notes(
+                    package,
+                    note_ids,
                     hide_fields=config['hidden_fields'],
-                    media_dir=self.other_col.media_dir,
                     previewer=config['preview_on_right_side'],
+                    imported=imported,
                 )
-            except Exception as e:
-                showInfo(f"error: {e}")
-                return
+            self.search_result_label.set_count(found, displayed)
+            show_span.count(found=found, displayed=displayed, latency_ms=search_latency_ms(started))
+
+    def _show_search_error(self, error: Exception, typed: bool):
+        if typed:
+            # The query may be half-typed. Don't pop up a dialog that takes the focus from the search box.
+            self.search_result_label.set_error(str(error))
         else:
-            try:
-                limited_note_ids=[]
-                self.note_list.clear()
-                for col_path in self.col_list:
-                    col_file = col_path.replace("/", "\\")
-                    cm = CollectionManager()
-                    cm.open(col_file)
-                    self.col_dict[col_file] = cm
-                    note_ids = cm.find_notes(cm.col_name_and_id(), self.search_term_edit.text())
-                    limited_note_ids += note_ids
-                    self.note_list.add_notes(
-                        map(cm.get_note, note_ids),
-                        hide_fields=config['hidden_fields'],
-                        media_dir=cm.media_dir,
-                        previewer=config['preview_on_right_side'],
-                    )
-            except Exception as e:
-                showInfo(f"error: {e}")
-                return
-        self.search_result_label.set_count(len(limited_note_ids), len(limited_note_ids))
+            self.search_result_label.hide()
+            showInfo(f"error: {error}")
 
     def do_import(self):
         logDebug('beginning import')
 
         # get selected notes
-        notes = self.note_list.selected_notes()
+        rows = self.note_list.selected_rows()
+        if not rows:
+            # Importing nothing would still leave an empty undo step.
+            return
+        refs = self.note_list.note_refs(rows)
+        generation = self._search_generation
 
         # clear the selection
         self.note_list.clear_selection()
 
-        logDebug(f'importing {len(notes)} notes')
-
-        results = []
-
-        for note in notes:
-            results.append(import_note(
-                other_note=note,
-                model_id=self.note_type_selection_combo.currentData(),
-                deck_id=self.current_profile_deck_combo.currentData(),
-            ))
-
-        self.status_bar.set_status(results.count(ImportResult.success), results.count(ImportResult.dupe))
-        mw.reset()
+        logDebug(f'importing {len(refs)} notes')
+
+        importer = NoteImporter(
+            col=mw.col,
+            model_id=self.note_type_selection_combo.currentData(),
+            deck_id=self.current_profile_deck_combo.currentData(),
+            ledger=ledger,
+        )
+        # The main window refreshes only the views affected by the returned changes.
+        # Notes are read in the background too, because the first read opens the package's full collection.
+        CollectionOp(
+            parent=self,
+            op=lambda col: importer.import_notes([package.get_source_note(note_id) for package, note_id in refs]),
+        ).success(lambda summary: self._on_import_finished(generation, rows, summary)).run_in_background()
+
+    def _on_import_finished(self, generation: int, rows: list[int], summary: ImportSummary):
+        logDebug(
+            f'imported {summary.successes} notes, skipped {summary.dupes} dupes '
+            f'in {summary.elapsed:.2f}s ({summary.notes_per_second:.0f} notes/s)'
+        )
+        self.status_bar.set_status(summary.successes, summary.dupes, summary.notes_per_second)
+        if generation == self._search_generation:
+            # The list still shows the same results.
+            self.note_list.mark_imported(
+                row for row, result in zip(rows, summary.results) if result == ImportResult.success
+            )
 
     def on_open_settings(self):
+        # Closing the window closes the packages and deletes their temporary files, so measure before.
+        disk_usage = disk_usage_text()
         self.close()
-        dialog = CroProSettingsDialog(main_form=self, current_col=self.current_col, parent=mw)
+        dialog = CroProSettingsDialog(main_form=self, current_col=self.current_col, disk_usage=disk_usage, parent=mw)
         dialog.exec()
 
     def done(self, result_code):
         self.window_state.save()
+        self.cancel_open_apkg()
+        self._search_timer.stop()
+        self._search_generation += 1
+        # The dialog is reused, and its rows must not outlive the packages they refer to.
+        self.note_list.clear()
+        self.search_result_label.hide()
         self.other_col.close_all()
+        self.package_pool.close_all()
         return super().done(result_code)
 
 
@@ -361,3 +585,8 @@ def init():
     root_menu.addAction(action)
     # hook to close
     gui_hooks.profile_will_close.append(d.close)
+    # The ledger of imported notes lives in the profile folder.
+    gui_hooks.profile_did_open.append(lambda: ledger.open(mw.col.path))
+    gui_hooks.profile_will_close.append(ledger.close)
+    # Extracted packages are removed on close, so folders of processes that are gone are from a crashed session.
+    gui_hooks.profile_did_open.append(lambda: mw.taskman.run_in_background(workspace.remove_leftovers))
@@ -0,0 +1,123 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import functools
+import os
+import re
+import sqlite3
+import string
+import threading
+from typing import Optional, Sequence
+
+from anki.notes import NoteId
+
+from .apkg_file import ProgressFn
+from .package_reader import PackageReader
+
+STAGE_FTS = "Building search index"
+# The trigram tokenizer can match substrings, like Anki's own search, but only three characters or longer.
+MIN_TERM_LENGTH = 3
+# Terms that contain these characters use Anki search syntax: "deck:", wildcards, quotes, negation, grouping.
+SPECIAL_CHARS_RE = re.compile(r'[:"*_\\()\-]')
+BUILD_BATCH_SIZE = 5_000
+# Matches like SQLite's LIKE, which PackageReader uses for short terms:
+# case is ignored for ASCII letters only, so text and terms are lowercased the same way.
+TOKENIZE = "trigram case_sensitive 1"
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+# Changes whenever the contents of the index change, so that old indexes are rebuilt.
+INDEX_VERSION = 2
+
+
+@functools.cache
+def is_fts_available() -> bool:
+    """Checks that SQLite was built with FTS5 and has the trigram tokenizer (3.34+)."""
+    try:
+        with sqlite3.connect(':memory:') as db:
+            db.execute(f"create virtual table t using fts5(a, tokenize='{TOKENIZE}')")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def plain_terms(query: str, min_length: int = MIN_TERM_LENGTH) -> Optional[list[str]]:
+    """Returns the terms of a query that can be answered by the index, or None if it uses Anki syntax."""
+    terms = query.split()
+    if not terms:
+        return None
+    for term in terms:
+        if len(term) < min_length or term.lower() in ('or', 'and') or SPECIAL_CHARS_RE.search(term):
+            return None
+    return terms
+
+
+class FullTextIndex:
+    """
+    An SQLite FTS5 index over the note fields of an extracted package.
+    It is stored next to the collection and rebuilt when the notes change.
+    """
+
+    def __init__(self, col_path: str):
+        self._path = f"{os.path.splitext(col_path)[0]}.fts.sqlite"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute("create table if not exists meta (key text primary key, value text)")
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def ensure_built(
+            self,
+            reader: PackageReader,
+            progress: Optional[ProgressFn] = None,
+            signature: Optional[str] = None,
+    ) -> None:
+        """
+        Builds the index unless it was built for the same signature.
+        Pass the package fingerprint as the signature if the notes can't change, e.g. for cached packages.
+        Otherwise it's computed from the notes, which reads the whole table.
+        """
+        signature = f"{INDEX_VERSION}:{signature or self._signature(reader)}"
+        with self._lock:
+            row = self._db.execute("select value from meta where key = 'signature'").fetchone()
+            if row and row[0] == signature:
+                return
+            self._build(reader, signature, progress)
+
+    def search(self, terms: Sequence[str]) -> list[NoteId]:
+        """Returns ids of notes that contain all terms, in ascending order."""
+        match = ' AND '.join('"{}"'.format(term.translate(ASCII_LOWER).replace('"', '""')) for term in terms)
+        with self._lock:
+            return [
+                NoteId(rowid) for (rowid,) in
+                self._db.execute("select rowid from notes_fts where notes_fts match ? order by rowid", (match,))
+            ]
+
+    @staticmethod
+    def _signature(reader: PackageReader) -> str:
+        count, max_mod = reader.first("select count(), max(mod) from notes")
+        return f"{count}:{max_mod}"
+
+    def _build(self, reader: PackageReader, signature: str, progress: Optional[ProgressFn]) -> None:
+        total = reader.scalar("select count() from notes")
+        with self._db:
+            self._db.execute("drop table if exists notes_fts")
+            self._db.execute(f"create virtual table notes_fts using fts5(flds, tokenize='{TOKENIZE}')")
+            done, last_id = 0, 0
+            while rows := reader.all(
+                    "select id, flds from notes where id > ? order by id limit ?", last_id, BUILD_BATCH_SIZE
+            ):
+                self._db.executemany(
+                    "insert into notes_fts (rowid, flds) values (?, ?)",
+                    ((nid, flds.translate(ASCII_LOWER)) for nid, flds in rows),
+                )
+                done += len(rows)
+                last_id = rows[-1][0]
+                if progress:
+                    progress(STAGE_FTS, done, total)
+            self._db.execute("insert or replace into meta (key, value) values ('signature', ?)", (signature,))
@@ -0,0 +1,214 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Imports notes from a package without opening Anki, e.g. as a scheduled job.
+Anki must not have the target collection open at the same time.
+
+Run from the addons21 folder:
+    python -m <add-on folder>.headless bank.apkg ~/.local/share/Anki2/User\\ 1/collection.anki2 \\
+        --query "食べる" --query "飲む" --deck "Mining" --map "Japanese sentences=Mining"
+
+A JSON summary is printed to stdout. Debug messages go to stderr.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import zipfile
+from typing import NamedTuple, Optional, Sequence
+
+from anki.collection import Collection
+from anki.notes import NoteId
+
+from .collection_manager import CollectionManager, NameId
+from .config import config
+from .import_ledger import ImportLedger
+from .note_importer import NoteImporter, ImportOptions
+from .package_cache import package_cache
+from .workspace import workspace
+
+
+class HeadlessReport(NamedTuple):
+    package: str
+    collection: str
+    # query -> number of notes found
+    found: dict[str, int]
+    selected: int
+    imported: int
+    duplicates: int
+    notes_per_second: float
+    # stage -> seconds
+    timings: dict[str, float]
+
+
+class Stopwatch:
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 4)
+
+    def finish(self) -> dict[str, float]:
+        self.timings['total'] = round(time.perf_counter() - self._start, 4)
+        return self.timings
+
+
+def find_deck(decks: Sequence[NameId], name: str) -> NameId:
+    for deck in decks:
+        if deck.name == name:
+            return deck
+    raise ValueError(f"deck \"{name}\" doesn't exist in the package.")
+
+
+def find_note_type_id(col: Collection, name: Optional[str]) -> int:
+    if name is None:
+        return NameId.none_type().id
+    if (model_id := col.models.id_for_name(name)) is None:
+        raise ValueError(f"note type \"{name}\" doesn't exist in the collection.")
+    return model_id
+
+
+def import_from_package(
+        package_path: str,
+        collection_path: str,
+        queries: Sequence[str],
+        deck_name: str,
+        from_deck: Optional[str] = None,
+        note_type: Optional[str] = None,
+        note_type_mapping: Optional[dict[str, str]] = None,
+        options: Optional[ImportOptions] = None,
+) -> HeadlessReport:
+    """
+    Finds the notes matching any of the queries in the package and imports them into the collection.
+    note_type_mapping maps note type names in the package to note type names in the collection.
+    Notes whose note type isn't mapped go to note_type, or to a matching (or cloned) note type if it's None.
+    Imports are recorded in the collection's ledger, shared with the add-on,
+    so notes imported from the same package before are skipped as duplicates.
+    """
+    package_path = os.path.abspath(package_path)
+    collection_path = os.path.abspath(collection_path)
+    # Keep extracted packages in the profile folder, like Anki does.
+    package_cache.set_root(os.path.dirname(collection_path))
+    # Folders of processes that are still running, e.g. Anki itself, are kept.
+    workspace.remove_leftovers()
+    stopwatch = Stopwatch()
+    manager = CollectionManager()
+    ledger = ImportLedger()
+    col = None
+    try:
+        with stopwatch.stage('open_package'):
+            package = manager.open_package(package_path)
+        with stopwatch.stage('search'):
+            deck = find_deck(package.deck_names_and_ids(), from_deck) if from_deck else manager.col_name_and_id()
+            found: dict[str, int] = {}
+            # Notes matched by several queries are imported once, in the order they were found.
+            note_ids: dict[NoteId, None] = {}
+            for query in queries:
+                ids = package.find_notes(deck, query)
+                found[query] = len(ids)
+                note_ids.update(dict.fromkeys(ids))
+        with stopwatch.stage('open_collection'):
+            col = Collection(collection_path)
+            ledger.open(collection_path)
+        with stopwatch.stage('import'):
+            importer = NoteImporter(
+                col=col,
+                model_id=find_note_type_id(col, note_type),
+                deck_id=col.decks.id(deck_name, create=True),
+                options=options,
+                note_type_mapping={
+                    source_name: find_note_type_id(col, target_name)
+                    for source_name, target_name in (note_type_mapping or {}).items()
+                },
+                ledger=ledger,
+            )
+            summary = importer.import_notes([package.get_source_note(note_id) for note_id in note_ids])
+    finally:
+        if col is not None:
+            col.close()
+        ledger.close()
+        manager.close_all()
+    return HeadlessReport(
+        package=package_path,
+        collection=collection_path,
+        found=found,
+        selected=len(note_ids),
+        imported=summary.successes,
+        duplicates=summary.dupes,
+        notes_per_second=round(summary.notes_per_second, 2),
+        timings=stopwatch.finish(),
+    )
+
+
+def parse_mapping(pairs: Sequence[str]) -> dict[str, str]:
+    mapping = {}
+    for pair in pairs:
+        source_name, sep, target_name = pair.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected \"source=target\", got \"{pair}\".")
+        mapping[source_name] = target_name
+    return mapping
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Import notes from an .apkg file into a collection.")
+    parser.add_argument('package', help="path to the .apkg/.colpkg file to import from")
+    parser.add_argument('collection', help="path to the collection.anki2 file to import into")
+    parser.add_argument('-q', '--query', action='append', required=True, help="Anki search; may be repeated")
+    parser.add_argument('-d', '--deck', required=True, help="deck to import into; created if missing")
+    parser.add_argument('--from-deck', help="only search this deck of the package")
+    parser.add_argument('--note-type', help="note type to use for all notes (default: matching or cloned)")
+    parser.add_argument(
+        '--map', action='append', default=[], metavar='SOURCE=TARGET',
+        help="use the TARGET note type for notes of the SOURCE note type; may be repeated",
+    )
+    parser.add_argument('--keep-duplicates', action='store_true', help="import notes that already exist")
+    parser.add_argument('--no-tags', action='store_true', help="don't copy tags of the imported notes")
+    parser.add_argument('--no-cache', action='store_true', help="don't keep the extracted package for later runs")
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    try:
+        mapping = parse_mapping(args.map)
+    except argparse.ArgumentTypeError as ex:
+        parser.error(str(ex))
+    if args.no_cache:
+        config['package_cache_size_mb'] = 0
+    options = ImportOptions(
+        skip_duplicates=not args.keep_duplicates,
+        copy_tags=not args.no_tags,
+    )
+    try:
+        report = import_from_package(
+            package_path=args.package,
+            collection_path=args.collection,
+            queries=args.query,
+            deck_name=args.deck,
+            from_deck=args.from_deck,
+            note_type=args.note_type,
+            note_type_mapping=mapping,
+            options=options,
+        )
+    except (ValueError, OSError, zipfile.BadZipFile) as ex:
+        print(f"error: {ex}", file=sys.stderr)
+        return 1
+    print(json.dumps(report._asdict(), indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import ntpath
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from anki.collection import Collection
+from anki.notes import NoteId
+from anki.utils import ids2str
+
+LEDGER_FILE_NAME = 'cropro_ledger.sqlite'
+
+
+def package_identity(package_name: str) -> str:
+    """
+    Packages are told apart by file name, so that a package that was moved or downloaded again
+    (e.g. a new version of a shared deck) is still recognized. Accepts both path separators.
+    """
+    return ntpath.basename(package_name)
+
+
+class ImportLedger:
+    """
+    Remembers which notes were imported from which package, and the ids of the notes they became.
+    Stored next to the target collection, so it survives closing the packages and restarting Anki.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self, col_path: str) -> None:
+        """Opens the ledger of the collection at col_path, creating it if needed."""
+        path = os.path.join(os.path.dirname(col_path), LEDGER_FILE_NAME)
+        with self._lock:
+            self._close()
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                create table if not exists imported (
+                    package text not null,
+                    guid text not null,
+                    nid integer not null,
+                    time integer not null,
+                    primary key (package, guid)
+                ) without rowid
+            """)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._db is not None
+
+    def record(self, package_name: str, imported: Iterable[tuple[str, NoteId]]) -> None:
+        """Takes (source guid, new note id) pairs. A note imported again replaces the older entry."""
+        package = package_identity(package_name)
+        now = int(time.time())
+        with self._lock:
+            if self._db is None:
+                return
+            with self._db:
+                self._db.executemany(
+                    "insert or replace into imported (package, guid, nid, time) values (?, ?, ?, ?)",
+                    ((package, guid, nid, now) for guid, nid in imported),
+                )
+
+    def imported(self, package_name: str) -> dict[str, NoteId]:
+        """Source guid -> id of the note it was imported as, for every note imported from the package."""
+        with self._lock:
+            if self._db is None:
+                return {}
+            return {
+                guid: NoteId(nid) for guid, nid in
+                self._db.execute("select guid, nid from imported where package = ?", (package_identity(package_name),))
+            }
+
+    def imported_guids(self, package_name: str, col: Collection) -> set[str]:
+        """Guids of the notes imported from the package whose copies still exist, i.e. weren't undone or deleted."""
+        imported = self.imported(package_name)
+        if not imported:
+            return set()
+        existing = set(col.db.list(f"select id from notes where id in {ids2str(imported.values())}"))
+        return {guid for guid, nid in imported.items() if nid in existing}
+
+
+ledger = ImportLedger()
@@ -2,19 +2,31 @@
 # Copyright (c) 2023 mizmu addons 
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import os.path
+import hashlib
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from enum import Enum, auto
-from typing import NamedTuple, Iterable
+from typing import NamedTuple, Iterable, Sequence, Optional
 
+from anki.collection import Collection, OpChanges
 from anki.models import NoteType
 from anki.notes import Note
-from anki.utils import join_fields
-from aqt import mw
-from aqt.qt import *
+from anki.utils import join_fields, field_checksum
 
-from .collection_manager import NameId
+try:
+    from anki.collection import AddNoteRequest
+except ImportError:
+    # Anki before 2.1.55 can only add notes one by one.
+    AddNoteRequest = None
+
+from .apkg_file import MediaIndex, CHUNK_SIZE
+from .collection_manager import NameId, SourceNote
 from .config import config
+from .import_ledger import ImportLedger
+from .perf import span
 
 
 class ImportResult(Enum):
@@ -22,71 +34,305 @@ class ImportResult(Enum):
     dupe = auto()
 
 
+class ImportSummary(NamedTuple):
+    results: list[ImportResult]
+    elapsed: float
+    changes: OpChanges
+
+    @property
+    def successes(self) -> int:
+        return self.results.count(ImportResult.success)
+
+    @property
+    def dupes(self) -> int:
+        return self.results.count(ImportResult.dupe)
+
+    @property
+    def notes_per_second(self) -> float:
+        return len(self.results) / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class ImportOptions(NamedTuple):
+    skip_duplicates: bool = True
+    copy_tags: bool = True
+
+    @classmethod
+    def from_config(cls) -> 'ImportOptions':
+        return cls(
+            skip_duplicates=bool(config.get('skip_duplicates')),
+            copy_tags=bool(config.get('copy_tags')),
+        )
+
+
 class FileInfo(NamedTuple):
     name: str
     path: str
 
 
-def files_in_note(note: Note) -> Iterable[FileInfo]:
+def files_in_note(note: Note, media: MediaIndex) -> Iterable[FileInfo]:
     """
     Returns FileInfo for every file referenced by the note.
+    Files are extracted from the package on demand.
     Skips missing files.
     """
     for file_ref in note.col.media.files_in_str(note.mid, join_fields(note.fields)):
-        if os.path.exists(file_path := os.path.join(note.col.media.dir(), file_ref)):
+        if file_path := media.file_path(file_ref):
             yield FileInfo(file_ref, file_path)
 
 
-def copy_media_files(new_note: Note, other_note: Note) -> None:
-    # check if there are any media files referenced by the note
-    for file in files_in_note(other_note):
-        new_filename = new_note.col.media.addFile(file.path)
-        # NOTE: this_col_filename may differ from original filename (name conflict, different contents),
-        # in which case we need to update the note.
-        if new_filename != file.name:
-            new_note.fields = [field.replace(file.name, new_filename) for field in new_note.fields]
-
-
-def get_matching_model(model_id: int, reference_model: NoteType) -> NoteType:
-    if model_id != NameId.none_type().id:
-        # use existing note type (even if its name or fields are different)
-        return mw.col.models.get(model_id)
-    else:
-        # find a model in current profile that matches the name of model from other profile
-        # create a new note type (clone) if needed.
-        matching_model = mw.col.models.by_name(reference_model.get('name'))
-
-        if not matching_model or matching_model.keys() != reference_model.keys():
-            matching_model = deepcopy(reference_model)
-            matching_model['id'] = 0
-            mw.col.models.add(matching_model)
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MediaTransfer:
+    """
+    Copies the media files of a whole selection into the target collection.
+    Files are hashed once, in parallel, and every distinct file is copied once,
+    no matter how many notes reference it.
+    """
+
+    def __init__(self, col: Collection):
+        self._col = col
+        self._media_dir = col.media.dir()
+
+    def copy(self, notes: Sequence[tuple[Note, Note, MediaIndex]]) -> None:
+        """Takes (new note, other note, package media) and rewrites file names in the new notes if needed."""
+        # Files are extracted from the package here, unless they were extracted before.
+        with span('collect_files'):
+            files_by_note = [list(files_in_note(other_note, media)) for _new_note, other_note, media in notes]
+        source_paths = {file.path: file.name for files in files_by_note for file in files}
+        if not source_paths:
+            return
+        candidates = self._same_name_candidates(source_paths)
+        with span('hash_files', files=len(source_paths) + len(candidates)), \
+                ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            source_hashes = dict(zip(source_paths, executor.map(file_sha1, source_paths)))
+            target_hashes = dict(zip(
+                candidates,
+                executor.map(file_sha1, (os.path.join(self._media_dir, name) for name in candidates)),
+            ))
+
+        # content hash -> file name in the target collection
+        placed: dict[str, str] = {}
+        for name, sha1 in target_hashes.items():
+            placed.setdefault(sha1, name)
+        # source path -> file name in the target collection
+        renamed: dict[str, str] = {}
+        with span('add_files') as add_span:
+            for path, sha1 in source_hashes.items():
+                if sha1 not in placed:
+                    # NOTE: the new file name may differ from the original one (name conflict, different contents).
+                    placed[sha1] = self._col.media.add_file(path)
+                    add_span.count(files=1, bytes=os.path.getsize(path))
+                renamed[path] = placed[sha1]
+
+        for (new_note, _other_note, _media), files in zip(notes, files_by_note):
+            for file in files:
+                if (new_filename := renamed[file.path]) != file.name:
+                    new_note.fields = [field.replace(file.name, new_filename) for field in new_note.fields]
+
+    def _same_name_candidates(self, source_paths: dict[str, str]) -> list[str]:
+        """Target files that may already hold the source files: same name and size."""
+        # file name -> size, for every file in the target media folder
+        target_sizes = {entry.name: entry.stat().st_size for entry in os.scandir(self._media_dir)}
+        return [
+            name for path, name in source_paths.items()
+            if target_sizes.get(name) == os.path.getsize(path)
+        ]
+
+
+def field_signature(model: NoteType) -> str:
+    """Two note types with the same signature can hold the same notes."""
+    h = hashlib.sha1(str(model['type']).encode())
+    for field in model['flds']:
+        h.update(b'\x1f' + field['name'].encode())
+    return h.hexdigest()
+
+
+class NoteTypeResolver:
+    """
+    Maps each note type of the imported notes to one note type in the target collection.
+    Lives for one import session, so each source note type is checked and cloned at most once.
+    """
+
+    def __init__(self, col: Collection, model_id: int, mapping: Optional[dict[str, int]] = None):
+        self._col = col
+        self._model_id = model_id
+        # note type name in the package -> note type id in the target collection
+        self._mapping = mapping or {}
+        # (package collection, note type id) -> note type in the target collection
+        self._resolved: dict[tuple[str, int], NoteType] = {}
+        # field signature -> note types in the target collection
+        self._by_signature: Optional[dict[str, list[NoteType]]] = None
+
+    def resolve(self, other_note: Note) -> NoteType:
+        key = (other_note.col.path, other_note.mid)
+        if (model := self._resolved.get(key)) is None:
+            model = self._resolved[key] = self.get_matching_model(other_note.note_type())
+        return model
+
+    def get_matching_model(self, reference_model: NoteType) -> NoteType:
+        if (model_id := self._mapping.get(reference_model['name'])) is not None:
+            return self._col.models.get(model_id)
+        if self._model_id != NameId.none_type().id:
+            # use existing note type (even if its name or fields are different)
+            return self._col.models.get(self._model_id)
+        if matching_model := self._find_compatible(reference_model):
+            return matching_model
+        # create a new note type (clone).
+        matching_model = deepcopy(reference_model)
+        matching_model['id'] = 0
+        self._col.models.add(matching_model)
+        self._signature_index().setdefault(field_signature(matching_model), []).append(matching_model)
         return matching_model
 
+    def _find_compatible(self, reference_model: NoteType) -> Optional[NoteType]:
+        """
+        Finds a note type in the current profile that has the same fields as the model from the package.
+        Prefers the one with the same name, then clones made by earlier imports (e.g. "Basic-abcde").
+        """
+        candidates = self._signature_index().get(field_signature(reference_model), [])
+        name = reference_model['name']
+        for model in candidates:
+            if model['name'] == name:
+                return model
+        for model in candidates:
+            if model['name'].startswith(f"{name}-"):
+                return model
+        return None
+
+    def _signature_index(self) -> dict[str, list[NoteType]]:
+        if self._by_signature is None:
+            self._by_signature = {}
+            for model in self._col.models.all():
+                self._by_signature.setdefault(field_signature(model), []).append(model)
+        return self._by_signature
+
+
+class DuplicateIndex:
+    """
+    Built once per import from a single query over the target collection.
+    Answers whether a note is a duplicate without touching the database again.
+    """
+
+    def __init__(self, col: Collection):
+        self._guids: set[str] = set()
+        # (note type id, checksum of the first field)
+        self._checksums: set[tuple[int, int]] = set()
+        for guid, mid, csum in col.db.execute("select guid, mid, csum from notes"):
+            self._guids.add(guid)
+            self._checksums.add((mid, csum))
+
+    def is_dupe(self, new_note: Note, other_note: Note) -> bool:
+        return (
+                other_note.guid in self._guids
+                or (new_note.mid, field_checksum(new_note.fields[0])) in self._checksums
+        )
+
+    def add(self, new_note: Note, other_note: Note) -> None:
+        """Remembers a note that is about to be imported, so that dupes within one batch are caught too."""
+        self._guids.add(other_note.guid)
+        self._checksums.add((new_note.mid, field_checksum(new_note.fields[0])))
+
+
+class NoteImporter:
+    """
+    Imports notes from opened packages into a collection.
+    Everything is resolved up front, then all notes are added in one backend call and one undo step.
+    Imported notes are recorded in the ledger, if one is given,
+    and notes that were imported from the same package before count as duplicates.
+    """
+    undo_label = "Import notes from package"
+
+    def __init__(
+            self,
+            col: Collection,
+            model_id: int,
+            deck_id: int,
+            options: Optional[ImportOptions] = None,
+            note_type_mapping: Optional[dict[str, int]] = None,
+            ledger: Optional[ImportLedger] = None,
+    ):
+        self._col = col
+        self._deck_id = deck_id
+        self._options = options or ImportOptions.from_config()
+        self._note_types = NoteTypeResolver(col, model_id, note_type_mapping)
+        self._ledger = ledger
+        # package name -> guids of the notes imported from it before
+        self._imported_guids: dict[str, set[str]] = {}
+
+    def import_notes(self, notes: Sequence[SourceNote]) -> ImportSummary:
+        """Meant to be called as a CollectionOp (on a background thread)."""
+        start = time.perf_counter()
+        with span('import', notes=len(notes)) as import_span:
+            undo_pos = self._col.add_custom_undo_entry(self.undo_label)
+            with span('duplicate_index'):
+                dupes = DuplicateIndex(self._col) if self._options.skip_duplicates else None
+            new_notes = []
+            results = []
+            imported = []
+            to_copy = []
+            with span('make_notes'):
+                for other_note, media, package in notes:
+                    new_note = self._make_note(other_note)
+                    if dupes is not None:
+                        if dupes.is_dupe(new_note, other_note) or self._was_imported(package, other_note):
+                            results.append(ImportResult.dupe)
+                            continue
+                        dupes.add(new_note, other_note)
+                    to_copy.append((new_note, other_note, media))
+                    new_notes.append(new_note)
+                    results.append(ImportResult.success)
+                    imported.append((package, other_note.guid, new_note))
+            import_span.count(dupes=len(notes) - len(new_notes))
+            with span('media'):
+                MediaTransfer(self._col).copy(to_copy)
+            if new_notes:
+                with span('add_notes', notes=len(new_notes)):
+                    self._add_notes(new_notes)
+            if self._ledger is not None:
+                with span('record_imported'):
+                    self._record_imported(imported)
+            with span('merge_undo'):
+                changes = self._col.merge_undo_entries(undo_pos)
+        return ImportSummary(results, time.perf_counter() - start, changes)
+
+    def _add_notes(self, new_notes: list[Note]) -> None:
+        if AddNoteRequest is not None:
+            self._col.add_notes([AddNoteRequest(note, self._deck_id) for note in new_notes])
+        else:
+            for note in new_notes:
+                self._col.add_note(note, self._deck_id)
+
+    def _make_note(self, other_note: Note) -> Note:
+        new_note = Note(self._col, self._note_types.resolve(other_note))
+
+        for key in new_note.keys():
+            if key in other_note:
+                new_note[key] = str(other_note[key])
+
+        # copy field tags into new note object
+        if self._options.copy_tags:
+            new_note.tags = [tag for tag in other_note.tags if tag != 'leech']
+
+        return new_note
+
+    def _was_imported(self, package: str, other_note: Note) -> bool:
+        if self._ledger is None:
+            return False
+        if (guids := self._imported_guids.get(package)) is None:
+            guids = self._imported_guids[package] = self._ledger.imported_guids(package, self._col)
+        return other_note.guid in guids
 
-def import_note(other_note: Note, model_id: int, deck_id: int) -> ImportResult:
-    matching_model = get_matching_model(model_id, other_note.note_type())
-    new_note = Note(mw.col, matching_model)
-    new_note.note_type()['did'] = deck_id
-
-    for key in new_note.keys():
-        if key in other_note:
-            new_note[key] = str(other_note[key])
-
-    # copy field tags into new note object
-    if config.get('copy_tags'):
-        new_note.tags = [tag for tag in other_note.tags if tag != 'leech']
-
-    if config.get('tag_exported_cards') and (tag := config.get('exported_tag')):
-        other_note.add_tag(tag)
-        other_note.flush()
-
-    # check if note is dupe of existing one
-    # if config.get('skip_duplicates') and new_note.dupeOrEmpty():
-    #     return ImportResult.dupe
-    # else:
-    #     copy_media_files(new_note, other_note)
-    #     mw.col.addNote(new_note)
-    #     return ImportResult.success
-    copy_media_files(new_note, other_note)
-    mw.col.addNote(new_note)
-    return ImportResult.success
+    def _record_imported(self, imported: Sequence[tuple[str, str, Note]]) -> None:
+        """Takes (package name, source guid, new note). The new notes have ids once they are added."""
+        by_package = defaultdict(list)
+        for package, guid, new_note in imported:
+            by_package[package].append((guid, new_note.id))
+        for package, pairs in by_package.items():
+            self._ledger.record(package, pairs)
+            self._imported_guids.setdefault(package, set()).update(guid for guid, _nid in pairs)
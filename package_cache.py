@@ -0,0 +1,167 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from aqt import mw
+
+from .config import config
+
+CACHE_DIR_NAME = 'cropro_cache'
+INDEX_FILE_NAME = 'index.json'
+# How much of the head and the tail of a package goes into its fingerprint.
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+
+
+def fingerprint(package_path: str) -> str:
+    """
+    Identifies a package by its path, size, mtime and a hash of its first and last bytes.
+    Hashing the whole file would take as long as extracting it.
+    """
+    stat = os.stat(package_path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{os.path.abspath(package_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    with open(package_path, 'rb') as f:
+        h.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+        if stat.st_size > FINGERPRINT_SAMPLE_SIZE:
+            f.seek(max(FINGERPRINT_SAMPLE_SIZE, stat.st_size - FINGERPRINT_SAMPLE_SIZE))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+class CacheEntry(NamedTuple):
+    key: str
+    dir: str
+    ready: bool
+
+    @property
+    def col_path(self) -> str:
+        # Anki places the media folder next to the collection, i.e. "collection.media".
+        return os.path.join(self.dir, 'collection.anki2')
+
+
+class PackageCache:
+    """
+    Keeps extracted collections and media of recently opened packages in the profile folder.
+    Entries are evicted in least-recently-used order once the size limit is exceeded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_use: set[str] = set()
+        self._root: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.size_limit > 0
+
+    @property
+    def size_limit(self) -> int:
+        return int(config['package_cache_size_mb']) * 1024 * 1024
+
+    @property
+    def root(self) -> str:
+        return self._root or os.path.join(mw.pm.profileFolder(), CACHE_DIR_NAME)
+
+    def set_root(self, folder: str) -> None:
+        """Places the cache in another folder. Used outside of Anki, where there's no profile folder."""
+        with self._lock:
+            self._root = os.path.join(folder, CACHE_DIR_NAME)
+
+    def used_bytes(self) -> int:
+        with self._lock:
+            return sum(info['size'] for info in self._read_index().values())
+
+    def acquire(self, package_path: str) -> Optional[CacheEntry]:
+        """
+        Returns a cache entry for the package and marks it as used.
+        If the entry isn't ready, the caller has to extract the package into it and call mark_ready().
+        Returns None if the cache is disabled or the entry is already opened by someone else.
+        """
+        if not self.enabled:
+            return None
+        key = fingerprint(package_path)
+        with self._lock:
+            if key in self._in_use:
+                return None
+            index = self._read_index()
+            entry_dir = os.path.join(self.root, key)
+            if ready := (key in index and os.path.isdir(entry_dir)):
+                index[key]['last_used'] = time.time()
+                self._write_index(index)
+            else:
+                # Leftovers of an interrupted extraction.
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.makedirs(entry_dir, exist_ok=True)
+            self._in_use.add(key)
+        return CacheEntry(key, entry_dir, ready)
+
+    def mark_ready(self, entry: CacheEntry, package_path: str) -> CacheEntry:
+        with self._lock:
+            index = self._read_index()
+            index[entry.key] = {
+                'package': package_path,
+                'size': dir_size(entry.dir),
+                'last_used': time.time(),
+            }
+            self._write_index(index)
+            self._evict(index)
+        return entry._replace(ready=True)
+
+    def release(self, entry: CacheEntry) -> None:
+        """Records the current size of the entry (media may have been extracted since) and evicts old entries."""
+        with self._lock:
+            self._in_use.discard(entry.key)
+            index = self._read_index()
+            if entry.key in index:
+                index[entry.key]['size'] = dir_size(entry.dir)
+                index[entry.key]['last_used'] = time.time()
+            else:
+                shutil.rmtree(entry.dir, ignore_errors=True)
+            self._evict(index)
+
+    def _evict(self, index: dict[str, dict]) -> None:
+        total = sum(info['size'] for info in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.size_limit:
+                break
+            if key in self._in_use:
+                continue
+            total -= index.pop(key)['size']
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        self._write_index(index)
+
+    def _read_index(self) -> dict[str, dict]:
+        try:
+            with open(os.path.join(self.root, INDEX_FILE_NAME), encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index: dict[str, dict]) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = os.path.join(self.root, f'{INDEX_FILE_NAME}.tmp')
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(index, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.root, INDEX_FILE_NAME))
+
+
+package_cache = PackageCache()
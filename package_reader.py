@@ -0,0 +1,179 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import json
+import sqlite3
+import threading
+import urllib.request
+from typing import Any, Callable, Iterable, NamedTuple, Optional, Sequence
+
+from anki.collection import Collection
+from anki.dbproxy import DBProxy
+from anki.notes import NoteId
+from anki.utils import ids2str
+
+# Since schema 15, decks and note types live in their own tables, and deck names are separated with \x1f.
+FIRST_SPLIT_SCHEMA = 15
+LEGACY_DECK_SEPARATOR = '::'
+DECK_SEPARATOR = '\x1f'
+# Stays below SQLite's limit on the number of query parameters.
+GUID_BATCH_SIZE = 500
+
+
+class NoteTypeInfo(NamedTuple):
+    mod: int
+    field_names: list[str]
+
+
+class PackageReader:
+    """
+    Reads an extracted collection with plain SQLite, without starting Anki's backend.
+    Enough for listing decks and note types, plain-text searches and reading note fields.
+    The database is opened read-only, so nothing is upgraded, checked or locked.
+    Once a full Collection is opened on the same file, reads go through its connection instead.
+    """
+
+    def __init__(self, col_path: str):
+        self._path = col_path
+        self._lock = threading.Lock()
+        self._db = self._connect(immutable=True)
+        # Set once a full Collection has the file open.
+        self._col_db: Optional[DBProxy] = None
+        self._schema: int = self.scalar("select ver from col")
+        # note type id -> modification time and field names
+        self._note_types: Optional[dict[int, NoteTypeInfo]] = None
+
+    def _connect(self, immutable: bool) -> sqlite3.Connection:
+        uri = f"file:{urllib.request.pathname2url(self._path)}?mode=ro"
+        if immutable:
+            # Skips locking and change detection. Only valid while nobody else writes to the file.
+            uri += "&immutable=1"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def hand_over(self, open_collection: Callable[[], Collection]) -> Collection:
+        """
+        Opens the full Collection on the same file and reads through its connection from then on.
+        Anki keeps the file locked exclusively while it's open, so no other connection can read it.
+        Reads wait until the Collection is open, because opening may upgrade the file.
+        """
+        with self._lock:
+            self._db.close()
+            try:
+                col = open_collection()
+            except BaseException:
+                self._db = self._connect(immutable=False)
+                raise
+            self._col_db = col.db
+            self._schema = col.db.scalar("select ver from col")
+            self._note_types = None
+        return col
+
+    def close(self) -> None:
+        with self._lock:
+            # The Collection, if any, is closed by its owner.
+            self._col_db = None
+            self._db.close()
+
+    # The same methods as anki.dbproxy.DBProxy, so that either can be passed to FullTextIndex.
+
+    def all(self, sql: str, *args: Any) -> list[Sequence]:
+        with self._lock:
+            if self._col_db is not None:
+                return self._col_db.all(sql, *args)
+            return self._db.execute(sql, args).fetchall()
+
+    def first(self, sql: str, *args: Any) -> Optional[Sequence]:
+        with self._lock:
+            if self._col_db is not None:
+                return self._col_db.first(sql, *args)
+            return self._db.execute(sql, args).fetchone()
+
+    def scalar(self, sql: str, *args: Any) -> Any:
+        row = self.first(sql, *args)
+        return row[0] if row else None
+
+    def _column(self, sql: str, *args: Any) -> list:
+        return [row[0] for row in self.all(sql, *args)]
+
+    # Collection metadata.
+
+    def deck_names_and_ids(self) -> list[tuple[str, int]]:
+        if self._schema >= FIRST_SPLIT_SCHEMA:
+            return [
+                (name.replace(DECK_SEPARATOR, LEGACY_DECK_SEPARATOR), deck_id)
+                for deck_id, name in self.all("select id, name from decks")
+            ]
+        decks = json.loads(self.scalar("select decks from col"))
+        return [(deck['name'], int(deck_id)) for deck_id, deck in decks.items()]
+
+    def deck_and_child_ids(self, deck_id: int) -> list[int]:
+        decks = self.deck_names_and_ids()
+        name = next((name for name, did in decks if did == deck_id), None)
+        if name is None:
+            return []
+        return [did for child_name, did in decks if child_name == name or child_name.startswith(name + '::')]
+
+    def field_names(self, mid: int) -> list[str]:
+        return info.field_names if (info := self._note_type(mid)) else []
+
+    def note_type_mod(self, mid: int) -> int:
+        return info.mod if (info := self._note_type(mid)) else 0
+
+    def _note_type(self, mid: int) -> Optional[NoteTypeInfo]:
+        if self._note_types is None:
+            self._note_types = self._read_note_types()
+        return self._note_types.get(mid)
+
+    def _read_note_types(self) -> dict[int, NoteTypeInfo]:
+        result: dict[int, NoteTypeInfo] = {}
+        if self._schema >= FIRST_SPLIT_SCHEMA:
+            for ntid, mod, name in self.all(
+                    "select n.id, n.mtime_secs, f.name from notetypes n "
+                    "join fields f on f.ntid = n.id order by n.id, f.ord"
+            ):
+                result.setdefault(ntid, NoteTypeInfo(mod, [])).field_names.append(name)
+        else:
+            models = json.loads(self.scalar("select models from col"))
+            for mid, model in models.items():
+                result[int(mid)] = NoteTypeInfo(
+                    model.get('mod', 0),
+                    [field['name'] for field in sorted(model['flds'], key=lambda field: field['ord'])],
+                )
+        return result
+
+    # Notes.
+
+    def all_note_ids(self) -> list[NoteId]:
+        return [NoteId(nid) for nid in self._column("select id from notes order by id")]
+
+    def note_ids_in_decks(self, deck_ids: Iterable[int]) -> set[NoteId]:
+        return set(self._column(f"select distinct nid from cards where did in {ids2str(deck_ids)}"))
+
+    def search_plain(self, terms: Sequence[str], within: Optional[Sequence[NoteId]] = None) -> list[NoteId]:
+        """
+        Notes whose fields contain all terms, in ascending order.
+        If within is given, only those notes are checked, e.g. the results of an earlier search.
+        Like Anki's own search, matches the raw field contents. Case is ignored for ASCII letters only.
+        """
+        conditions = [r"flds like ? escape '\'" for _term in terms]
+        if within is not None:
+            conditions.insert(0, f"id in {ids2str(within)}")
+        patterns = ['%{}%'.format(term.replace('\\', r'\\').replace('%', r'\%').replace('_', r'\_')) for term in terms]
+        return [
+            NoteId(nid) for nid in
+            self._column(f"select id from notes where {' and '.join(conditions)} order by id", *patterns)
+        ]
+
+    def note_ids_by_guid(self, guids: Iterable[str]) -> set[NoteId]:
+        guids = list(guids)
+        result = set()
+        for start in range(0, len(guids), GUID_BATCH_SIZE):
+            batch = guids[start:start + GUID_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            result.update(self._column(f"select id from notes where guid in ({placeholders})", *batch))
+        return result
+
+    def fetch_notes(self, note_ids: Sequence[NoteId]) -> list[tuple[int, int, int, str]]:
+        """(id, mid, mod, flds) of the notes, in no particular order."""
+        return self.all(f"select id, mid, mod, flds from notes where id in {ids2str(note_ids)}")
@@ -0,0 +1,107 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Timing spans around the slow paths: opening packages, searching, filling the list, previewing and importing.
+Each finished operation is summarized in one line of the debug log,
+and can also be appended to a JSONL trace file for aggregation. Both are written on the log's writer thread.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Iterator
+
+from .common import LogDebug, log_dir
+from .config import config
+
+TRACE_FILE_NAME = 'cropro_trace.jsonl'
+
+logDebug = LogDebug()
+_local = threading.local()
+
+
+class Span:
+    """A timed stage of an operation. Counters record how much work was done, e.g. notes or bytes."""
+
+    def __init__(self, name: str, **counts: int):
+        self.name = name
+        self.counts: dict[str, int] = dict(counts)
+        self.children: list[Span] = []
+        self.seconds = 0.0
+        self.failed = False
+
+    def count(self, **counts: int) -> None:
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def to_dict(self) -> dict:
+        result = {'name': self.name, 'seconds': round(self.seconds, 6)}
+        if self.counts:
+            result['counts'] = self.counts
+        if self.failed:
+            result['failed'] = True
+        if self.children:
+            result['children'] = [child.to_dict() for child in self.children]
+        return result
+
+    def summary(self) -> str:
+        """E.g. "import 1.234s notes=100 failed | media 0.900s files=40 bytes=1234567, add_notes 0.300s"."""
+        line = self._describe()
+        if self.children:
+            line += ' | ' + ', '.join(child._describe() for child in self.children)
+        return line
+
+    def _describe(self) -> str:
+        parts = [self.name, f"{self.seconds:.3f}s"]
+        parts.extend(f"{key}={value}" for key, value in self.counts.items())
+        if self.failed:
+            parts.append('failed')
+        return ' '.join(parts)
+
+
+def _stack() -> list[Span]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def span(name: str, **counts: int) -> Iterator[Span]:
+    """
+    Times the enclosed block.
+    A span opened while another one is active on the same thread becomes its child.
+    Top-level spans are reported when they finish.
+    """
+    stack = _stack()
+    current = Span(name, **counts)
+    if stack:
+        stack[-1].children.append(current)
+    stack.append(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.failed = True
+        raise
+    finally:
+        current.seconds = time.perf_counter() - start
+        stack.pop()
+        if not stack:
+            report(current)
+
+
+def trace_path() -> str:
+    return os.path.join(log_dir(), TRACE_FILE_NAME)
+
+
+def report(root: Span) -> None:
+    logDebug.info(f"perf: {root.summary()}")
+    if not config.get('perf_trace'):
+        return
+    line = json.dumps({'time': round(time.time(), 3), 'thread': threading.current_thread().name, **root.to_dict()})
+    # Written on the log's background thread, together with other lines that arrive at the same time.
+    logDebug.append_line(trace_path(), line)
@@ -0,0 +1,101 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import os.path
+import threading
+from collections import OrderedDict
+from gettext import gettext as _
+from typing import Iterable, Sequence
+
+from anki.notes import NoteId
+from anki.utils import html_to_text_line
+
+from .ajt_common.media import find_sounds, find_images
+from .apkg_file import MediaIndex
+from .collection_manager import OpenedPackage
+from .thumbnails import ThumbnailCache, thumbnail_cache
+
+
+class PreviewRenderer:
+    """
+    Builds the previewer markup of notes from their fields.
+    The markup is cached by note id and mod time, so that notes next to the current one can be rendered ahead.
+    """
+
+    def __init__(self, max_cached_notes: int = 200, thumbnails: ThumbnailCache = thumbnail_cache):
+        self._max_cached_notes = max_cached_notes
+        self._thumbnails = thumbnails
+        self._lock = threading.Lock()
+        # (package, note id) -> (mod time, markup)
+        self._cache: OrderedDict[tuple[str, NoteId], tuple[int, str]] = OrderedDict()
+
+    def note_html(self, package: OpenedPackage, note_id: NoteId) -> str:
+        return self.notes_html(package, [note_id])[0]
+
+    def notes_html(self, package: OpenedPackage, note_ids: Sequence[NoteId]) -> list[str]:
+        rows = {row.id: row for row in package.fetch_rows(note_ids)}
+        result = []
+        for note_id in note_ids:
+            if (row := rows.get(note_id)) is None:
+                # The note has been deleted.
+                result.append('')
+                continue
+            key = (package.name, note_id)
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+            if cached is not None and cached[0] == row.mod:
+                result.append(cached[1])
+                continue
+            html = self.render(zip(package.field_names(row.mid), row.fields), package.media)
+            with self._lock:
+                self._cache[key] = (row.mod, html)
+                if len(self._cache) > self._max_cached_notes:
+                    self._cache.popitem(last=False)
+            result.append(html)
+        return result
+
+    def render(self, fields: Iterable[tuple[str, str]], media: MediaIndex) -> str:
+        """Takes (field name, field content) pairs."""
+        return ''.join(
+            f'<div class="name">{field_name}</div>'
+            f'<div class="content">{self._create_html_row_for_field(field_content, media)}</div>'
+            for field_name, field_content in fields
+        )
+
+    def _create_html_row_for_field(self, field_content: str, media: MediaIndex) -> str:
+        """Creates a row for the previewer showing the current note's field."""
+        markup = []
+        if audio_files := find_sounds(field_content):
+            markup.append(f'<div class="cropro__audio_list">{self._make_play_buttons(audio_files)}</div>')
+        if image_files := find_images(field_content):
+            markup.append(f'<div class="cropro__image_list">{self._make_images(image_files, media)}</div>')
+        if text := html_to_text_line(field_content):
+            markup.append(f'<div class="cropro__text_item">{text}</div>')
+        return ''.join(markup)
+
+    @staticmethod
+    def _make_play_buttons(audio_files: Iterable[str]) -> str:
+        return ''.join(
+            """
+            <button class="cropro__play_button" title="{}" onclick='pycmd("cropro__play_file:{}");'></button>
+            """.format(_(f"Play file: {f}"), f, )
+            for f in audio_files
+        )
+
+    def _make_images(self, image_files: Iterable[str], media: MediaIndex) -> str:
+        return ''.join(
+            f'<img alt="image:{os.path.basename(f)}" src="{self._image_src(f, media)}"/>'
+            for f in image_files
+        )
+
+    def _image_src(self, file_name: str, media: MediaIndex) -> str:
+        """Images are served by URL from the thumbnail cache, so the page doesn't grow with the image size."""
+        if not (file_path := media.file_path(file_name)):
+            return ''
+        try:
+            return self._thumbnails.url_for(file_path)
+        except OSError:
+            return ''
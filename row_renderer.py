@@ -0,0 +1,62 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+from collections import OrderedDict
+
+from anki.utils import html_to_text_line
+
+from .collection_manager import OpenedPackage, NoteRow
+
+
+class RowRenderer:
+    """
+    Turns note rows into the single line of text shown in the result list.
+    Which fields are visible is decided once per version of a note type,
+    and the stripped text is cached by note id and mod time, so refiltering skips HTML stripping.
+    """
+
+    def __init__(self, max_cached_rows: int = 50_000):
+        self._max_cached_rows = max_cached_rows
+        self._hide_fields: tuple[str, ...] = ()
+        # (package, note type id, note type mod time) -> indexes of visible fields
+        self._plans: dict[tuple[str, int, int], tuple[int, ...]] = {}
+        # (package, note id, mod time) -> text
+        self._texts: OrderedDict[tuple[str, int, int], str] = OrderedDict()
+
+    def set_hide_fields(self, hide_fields: list[str]) -> None:
+        if (hide_fields := tuple(field.lower() for field in hide_fields)) != self._hide_fields:
+            self._hide_fields = hide_fields
+            self._plans.clear()
+            self._texts.clear()
+
+    def text(self, package: OpenedPackage, row: NoteRow) -> str:
+        if not row.fields:
+            return ''
+        key = (package.name, row.id, row.mod)
+        if (text := self._texts.get(key)) is None:
+            text = self._texts[key] = ' | '.join(
+                line
+                for idx in self._plan(package, row.mid)
+                if idx < len(row.fields) and (line := html_to_text_line(row.fields[idx]))
+            )
+            if len(self._texts) > self._max_cached_rows:
+                self._texts.popitem(last=False)
+        else:
+            self._texts.move_to_end(key)
+        return text
+
+    def _plan(self, package: OpenedPackage, mid: int) -> tuple[int, ...]:
+        # A package with the same name may be reopened with changed note types, e.g. after it was downloaded again.
+        key = (package.name, mid, package.note_type_mod(mid))
+        if (plan := self._plans.get(key)) is None:
+            plan = self._plans[key] = tuple(
+                idx
+                for idx, field_name in enumerate(package.field_names(mid))
+                if not self._is_hidden(field_name)
+            )
+        return plan
+
+    def _is_hidden(self, field_name: str) -> bool:
+        field_name = field_name.lower()
+        return any(hidden_field in field_name for hidden_field in self._hide_fields)
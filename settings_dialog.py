@@ -11,7 +11,9 @@ from aqt.utils import restoreGeom, saveGeom, disable_help_button
 from .ajt_common.about_menu import tweak_window, menu_root_entry
 from .common import ADDON_NAME
 from .config import config, write_config
+from .package_cache import package_cache
 from .widgets import ItemBox, SpinBox
+from .workspace import workspace
 
 
 def fetch_toggleables() -> Iterable[str]:
@@ -24,13 +26,21 @@ def make_checkboxes() -> dict[str, QCheckBox]:
     return {key: QCheckBox(key.replace('_', ' ').capitalize()) for key in fetch_toggleables()}
 
 
+def disk_usage_text() -> str:
+    return "cache {:.1f} MiB, temporary files {:.1f} MiB".format(
+        package_cache.used_bytes() / 1024 / 1024,
+        workspace.used_bytes() / 1024 / 1024,
+    )
+
+
 class CroProSettingsDialog(QDialog):
     name = 'cropro_settings_dialog'
 
-    def __init__(self, main_form, current_col, *args, **kwargs) -> None:
+    def __init__(self, main_form, current_col, disk_usage: str, *args, **kwargs) -> None:
         QDialog.__init__(self, *args, **kwargs)
         self.main_form = main_form
         self.current_col = current_col
+        self.disk_usage = disk_usage
         disable_help_button(self)
         self._setup_ui()
         tweak_window(self)
@@ -59,14 +69,20 @@ class CroProSettingsDialog(QDialog):
         return layout
 
     def _make_form(self) -> QFormLayout:
-        self.tag_edit = QLineEdit(config['exported_tag'])
-        self.max_notes_edit = SpinBox(min_val=10, max_val=10_000, step=50, value=config['max_displayed_notes'])
+        self.max_notes_edit = SpinBox(min_val=0, max_val=1_000_000, step=500, value=config['max_displayed_notes'])
+        self.max_notes_edit.setSpecialValueText("No limit")
+        self.cache_size_edit = SpinBox(min_val=0, max_val=1_000_000, step=512, value=config['package_cache_size_mb'])
+        self.workspace_quota_edit = SpinBox(min_val=0, max_val=1_000_000, step=512, value=config['workspace_quota_mb'])
+        self.workspace_quota_edit.setSpecialValueText("No limit")
+        self.disk_usage_label = QLabel(self.disk_usage)
         self.hidden_fields_edit = QLineEdit()
         self.hidden_fields_edit.setPlaceholderText("New item")
 
         layout = QFormLayout()
         layout.addRow("Max displayed notes", self.max_notes_edit)
-        layout.addRow("Tag original cards with", self.tag_edit)
+        layout.addRow("Package cache size, MiB", self.cache_size_edit)
+        layout.addRow("Temporary files quota, MiB", self.workspace_quota_edit)
+        layout.addRow("Disk usage", self.disk_usage_label)
         layout.addRow("Hide fields matching", self.hidden_fields_edit)
         return layout
 
@@ -80,6 +96,14 @@ class CroProSettingsDialog(QDialog):
             "Hide fields whose names contain these words.\n"
             "Press space or comma to commit."
         )
+        self.cache_size_edit.setToolTip(
+            "Disk space for packages that were opened before.\n"
+            "Set to 0 to disable the cache."
+        )
+        self.workspace_quota_edit.setToolTip(
+            "Disk space for packages that are extracted outside of the cache.\n"
+            "When it's exceeded, packages that aren't shown are closed and their files are deleted."
+        )
 
     def finished(self, result: int) -> None:
         saveGeom(self, self.name)
@@ -87,7 +111,8 @@ class CroProSettingsDialog(QDialog):
 
     def accept(self) -> None:
         config['max_displayed_notes'] = self.max_notes_edit.value()
-        config['exported_tag'] = self.tag_edit.text()
+        config['package_cache_size_mb'] = self.cache_size_edit.value()
+        config['workspace_quota_mb'] = self.workspace_quota_edit.value()
         config['hidden_fields'] = self.hidden_fields_box.values()
         for key, checkbox in self.checkboxes.items():
             config[key] = checkbox.isChecked()
@@ -0,0 +1,35 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import importlib
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDON_PACKAGE = 'cropro_under_test'
+
+
+@pytest.fixture(scope='session')
+def addon():
+    """
+    The add-on as a package, without running its __init__.py, which expects to run inside Anki.
+    Modules are imported with addon.load('collection_manager').
+    """
+    if ADDON_PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            ADDON_PACKAGE,
+            os.path.join(ADDON_DIR, '__init__.py'),
+            submodule_search_locations=[ADDON_DIR],
+        )
+        sys.modules[ADDON_PACKAGE] = importlib.util.module_from_spec(spec)
+
+    class Addon:
+        @staticmethod
+        def load(name: str):
+            return importlib.import_module(f"{ADDON_PACKAGE}.{name}")
+
+    return Addon()
@@ -0,0 +1,57 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import zipfile
+
+import pytest
+
+# The add-on's package imports aqt, so both are needed.
+pytest.importorskip('anki')
+pytest.importorskip('aqt')
+
+
+def make_package(tmp_path) -> tuple[str, list[int]]:
+    """A legacy .apkg with two Basic notes and no media."""
+    from anki.collection import Collection
+
+    col_path = str(tmp_path / 'source.anki2')
+    col = Collection(col_path)
+    note_ids = []
+    for front in ('Hello world', 'Äpfel und Birnen'):
+        note = col.new_note(col.models.by_name('Basic'))
+        note['Front'] = front
+        note['Back'] = 'back'
+        col.add_note(note, col.decks.id('Default'))
+        note_ids.append(note.id)
+    col.close()
+    package_path = str(tmp_path / 'source.apkg')
+    with zipfile.ZipFile(package_path, 'w') as z:
+        z.write(col_path, 'collection.anki2')
+        z.writestr('media', '{}')
+    return package_path, note_ids
+
+
+def test_reads_after_collection_opens(tmp_path, addon):
+    """Anki locks an open collection exclusively, so the reader must switch to the Collection's connection."""
+    collection_manager = addon.load('collection_manager')
+    addon.load('package_cache').package_cache.set_root(str(tmp_path / 'profile'))
+    package_path, note_ids = make_package(tmp_path)
+    manager = collection_manager.CollectionManager()
+    try:
+        package = manager.open_package(package_path)
+        assert [row.id for row in package.fetch_rows(note_ids)] == note_ids
+
+        # An import or a search in Anki syntax opens the full Collection.
+        assert list(package.find_notes(manager.col_name_and_id(), 'front:Hello*')) == note_ids[:1]
+
+        assert [row.id for row in package.fetch_rows(note_ids)] == note_ids
+        assert package.reader.search_plain(['Birnen']) == note_ids[1:]
+        assert list(package.find_notes(manager.col_name_and_id(), 'world')) == note_ids[:1]
+        assert package.note_ids_by_guid([package.get_note(note_ids[0]).guid]) == {note_ids[0]}
+        assert 'Default' in [deck.name for deck in package.deck_names_and_ids()]
+        mid = package.get_note(note_ids[0]).mid
+        assert package.field_names(mid) == ['Front', 'Back']
+        assert package.note_type_mod(mid) == package.col.models.get(mid)['mod']
+    finally:
+        manager.close_all()
@@ -0,0 +1,99 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import hashlib
+import os
+import shutil
+import threading
+from typing import Optional
+
+from aqt.qt import *
+
+from .config import config
+
+THUMBNAILS_RELPATH = 'user_files/thumbnails'
+THUMBNAILS_DIR = os.path.join(os.path.dirname(__file__), *THUMBNAILS_RELPATH.split('/'))
+# Mediasrv only serves files of an add-on that match this pattern.
+THUMBNAILS_WEB_EXPORTS = r"user_files/thumbnails/[0-9a-f]+\.\w+"
+# Images that are already small enough are copied as is. Animated and vector images are never resized.
+MAX_SIDE = 800
+KEEP_AS_IS_EXTENSIONS = ('.gif', '.svg', '.webp')
+
+
+def thumbnail_name(file_path: str) -> str:
+    stat = os.stat(file_path)
+    key = hashlib.sha1(f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}|{MAX_SIDE}".encode()).hexdigest()[:24]
+    return key + os.path.splitext(file_path)[-1].lower()
+
+
+class ThumbnailCache:
+    """
+    Serves images to the previewer by URL instead of inlining them.
+    Large images are downscaled once and kept in a bounded folder inside the add-on's user_files.
+    """
+    # Same as mw.addonManager.addonFromModule(), but also works outside of Anki.
+    _url_root = f"/_addons/{__name__.split('.')[0]}/{THUMBNAILS_RELPATH}"
+
+    def __init__(self, folder: str = THUMBNAILS_DIR):
+        self._dir = folder
+        self._lock = threading.Lock()
+        self._total_size: Optional[int] = None
+
+    @property
+    def size_limit(self) -> int:
+        return int(config['thumbnail_cache_size_mb']) * 1024 * 1024
+
+    def url_for(self, file_path: str) -> str:
+        """Returns a URL the previewer can load the image from, creating its thumbnail if needed."""
+        name = thumbnail_name(file_path)
+        thumb_path = os.path.join(self._dir, name)
+        with self._lock:
+            if os.path.isfile(thumb_path):
+                # Mark as recently used.
+                os.utime(thumb_path)
+            else:
+                self._make_thumbnail(file_path, thumb_path)
+        return f"{self._url_root}/{name}"
+
+    def _make_thumbnail(self, file_path: str, thumb_path: str) -> None:
+        os.makedirs(self._dir, exist_ok=True)
+        # Written under a temporary name, so that an interrupted write never ends up in the cache.
+        tmp_path = f"{thumb_path}.part"
+        image = QImage()
+        if (
+                file_path.lower().endswith(KEEP_AS_IS_EXTENSIONS)
+                or not image.load(file_path)
+                or max(image.width(), image.height()) <= MAX_SIDE
+                or not image.scaled(
+                    MAX_SIDE, MAX_SIDE,
+                    Qt.AspectRatioMode.KeepAspectRatio,
+                    Qt.TransformationMode.SmoothTransformation,
+                ).save(tmp_path, os.path.splitext(thumb_path)[-1].lstrip('.'))
+        ):
+            shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, thumb_path)
+        self._add_size(os.path.getsize(thumb_path))
+
+    def _add_size(self, size: int) -> None:
+        if self._total_size is None:
+            self._total_size = sum(entry.stat().st_size for entry in os.scandir(self._dir)) - size
+        self._total_size += size
+        if self._total_size > self.size_limit:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Removes the least recently used thumbnails until the cache fits into half of the limit."""
+        entries = sorted(os.scandir(self._dir), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._total_size <= self.size_limit // 2:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._total_size -= size
+
+
+thumbnail_cache = ThumbnailCache()
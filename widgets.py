@@ -2,14 +2,18 @@
 # Copyright (c) 2023 mizmu addons 
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-from typing import Iterable, Collection
+import array
+import bisect
+from collections import OrderedDict
+from typing import Iterable, Sequence
 
-from anki.notes import Note
-from anki.utils import html_to_text_line
+from anki.notes import NoteId
 from aqt.qt import *
 
-from .collection_manager import NameId
+from .collection_manager import NameId, OpenedPackage, NoteRow
 from .note_previewer import NotePreviewer
+from .perf import span
+from .row_renderer import RowRenderer
 
 WIDGET_HEIGHT = 29
 
@@ -56,6 +60,18 @@ class SearchResultLabel(QLabel):
         super().__init__(*args, )
         self.setSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Maximum)
 
+    def set_searching(self):
+        self.setText('Searching...')
+        self.setStyleSheet('QLabel { color: gray; }')
+        if self.isHidden():
+            self.show()
+
+    def set_error(self, message: str):
+        self.setText(f'Search failed: {message}')
+        self.setStyleSheet('QLabel { color: red; }')
+        if self.isHidden():
+            self.show()
+
     def set_count(self, found: int, displayed: int):
         if found == 0:
             self.setText(f'No notes found')
@@ -70,6 +86,41 @@ class SearchResultLabel(QLabel):
             self.show()
 
 
+class OpenProgress(QWidget):
+    """Shows the progress of opening a package and lets the user cancel it."""
+    _steps = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._label = QLabel()
+        self._bar = QProgressBar()
+        self.cancel_button = QPushButton('Cancel')
+        self._setup_ui()
+        self.hide()
+
+    def _setup_ui(self):
+        self.setLayout(layout := QHBoxLayout())
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self._label)
+        layout.addWidget(self._bar, stretch=1)
+        layout.addWidget(self.cancel_button)
+        self._bar.setMaximumHeight(WIDGET_HEIGHT)
+        self._bar.setTextVisible(False)
+
+    def start(self):
+        self.set_progress('Opening package', 0, 0)
+        self.show()
+
+    def set_progress(self, stage: str, done: int, total: int):
+        self._label.setText(f'{stage}...')
+        if total > 0:
+            self._bar.setRange(0, self._steps)
+            self._bar.setValue(self._steps * min(done, total) // total)
+        else:
+            # Busy indicator.
+            self._bar.setRange(0, 0)
+
+
 class StatusBar(QHBoxLayout):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -92,9 +143,10 @@ class StatusBar(QHBoxLayout):
         self._dupes_label.hide()
         self._success_label.hide()
 
-    def set_status(self, successes: int, dupes: int):
+    def set_status(self, successes: int, dupes: int, notes_per_second: float = 0):
         if successes:
-            self._success_label.setText(f'{successes} notes successfully imported.')
+            speed = f' ({notes_per_second:.0f} notes/s)' if notes_per_second else ''
+            self._success_label.setText(f'{successes} notes successfully imported{speed}.')
             self._success_label.show()
         else:
             self._success_label.hide()
@@ -165,19 +217,143 @@ class ItemBox(QWidget):
             edit.setText('')
 
 
+class NoteListModel(QAbstractListModel):
+    """
+    Keeps only the ids of found notes.
+    Rows are exposed to the view in batches, and their text is fetched in pages as the user scrolls.
+    Notes that were imported before are shown in italics.
+    """
+    _fetch_batch = 1000
+    _page_size = 100
+    _max_cached_pages = 50
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._packages: list[OpenedPackage] = []
+        self._note_ids: list[array.array] = []
+        # ids of the notes of each package that were imported before
+        self._imported: list[set[NoteId]] = []
+        # first row of each package
+        self._offsets: list[int] = []
+        self._total = 0
+        self._shown = 0
+        self._renderer = RowRenderer()
+        self._pages: OrderedDict[int, list[str]] = OrderedDict()
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._shown
+
+    def canFetchMore(self, parent: QModelIndex = QModelIndex()) -> bool:
+        return not parent.isValid() and self._shown < self._total
+
+    def fetchMore(self, parent: QModelIndex = QModelIndex()) -> None:
+        if parent.isValid():
+            return
+        count = min(self._fetch_batch, self._total - self._shown)
+        self.beginInsertRows(QModelIndex(), self._shown, self._shown + count - 1)
+        self._shown += count
+        self.endInsertRows()
+
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            page, pos = divmod(index.row(), self._page_size)
+            return self._page(page)[pos]
+        if role in (Qt.ItemDataRole.FontRole, Qt.ItemDataRole.ToolTipRole) and self.is_imported(index.row()):
+            if role == Qt.ItemDataRole.ToolTipRole:
+                return "Imported before"
+            font = QFont()
+            font.setItalic(True)
+            return font
+        return None
+
+    def clear(self) -> None:
+        self.beginResetModel()
+        self._packages.clear()
+        self._note_ids.clear()
+        self._imported.clear()
+        self._offsets.clear()
+        self._pages.clear()
+        self._total = self._shown = 0
+        self.endResetModel()
+
+    def set_hide_fields(self, hide_fields: list[str]) -> None:
+        self._renderer.set_hide_fields(hide_fields)
+
+    def add_notes(self, package: OpenedPackage, note_ids: Sequence[NoteId], imported: Iterable[NoteId] = ()) -> None:
+        if not note_ids:
+            return
+        self._packages.append(package)
+        self._note_ids.append(array.array('q', note_ids))
+        self._imported.append(set(imported))
+        self._offsets.append(self._total)
+        self._total += len(note_ids)
+        if self._shown == 0:
+            self.fetchMore()
+
+    def note_ref(self, row: int) -> tuple[OpenedPackage, NoteId]:
+        idx = bisect.bisect_right(self._offsets, row) - 1
+        return self._packages[idx], NoteId(self._note_ids[idx][row - self._offsets[idx]])
+
+    def is_imported(self, row: int) -> bool:
+        idx = bisect.bisect_right(self._offsets, row) - 1
+        return self._note_ids[idx][row - self._offsets[idx]] in self._imported[idx]
+
+    def mark_imported(self, rows: Iterable[int]) -> None:
+        for row in rows:
+            idx = bisect.bisect_right(self._offsets, row) - 1
+            self._imported[idx].add(NoteId(self._note_ids[idx][row - self._offsets[idx]]))
+        if self._shown:
+            self.dataChanged.emit(
+                self.index(0), self.index(self._shown - 1),
+                [Qt.ItemDataRole.FontRole, Qt.ItemDataRole.ToolTipRole],
+            )
+
+    def _page(self, page: int) -> list[str]:
+        if (texts := self._pages.get(page)) is None:
+            first = page * self._page_size
+            last = min(first + self._page_size, self._total)
+            with span('list_page', rows=last - first) as page_span:
+                rows = list(self._fetch_rows(first, last))
+                with span('strip_html'):
+                    texts = self._pages[page] = [self._renderer.text(package, row) for package, row in rows]
+                page_span.count(chars=sum(map(len, texts)))
+            if len(self._pages) > self._max_cached_pages:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(page)
+        return texts
+
+    def _fetch_rows(self, first: int, last: int) -> Iterable[tuple[OpenedPackage, NoteRow]]:
+        """Reads rows first..last with one query per package that they belong to."""
+        idx = bisect.bisect_right(self._offsets, first) - 1
+        while first < last:
+            package, ids = self._packages[idx], self._note_ids[idx]
+            start = first - self._offsets[idx]
+            stop = min(len(ids), start + last - first)
+            wanted = [NoteId(nid) for nid in ids[start:stop]]
+            with span('fetch_rows', notes=len(wanted)):
+                rows = {row.id: row for row in package.fetch_rows(wanted)}
+            for nid in wanted:
+                # The note may have been deleted in the meantime.
+                yield package, rows.get(nid, NoteRow(nid, 0, 0, []))
+            first += stop - start
+            idx += 1
+
+
 class NoteList(QWidget):
     """Lists notes and previews them."""
-    _role = Qt.ItemDataRole.UserRole
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._note_list = QListWidget(self)
+        self._model = NoteListModel(self)
+        self._note_list = QListView(self)
+        self._note_list.setModel(self._model)
         self._previewer = NotePreviewer(self)
-        self._other_media_dir = None
         self._enable_previewer = True
         self._setup_ui()
-        self.itemDoubleClicked = self._note_list.itemDoubleClicked
-        qconnect(self._note_list.currentItemChanged, self._on_current_item_changed)
+        qconnect(self._note_list.selectionModel().currentChanged, self._on_current_changed)
 
     def _setup_ui(self):
         self.setLayout(layout := QHBoxLayout())
@@ -193,58 +369,63 @@ class NoteList(QWidget):
         self._note_list.setAlternatingRowColors(True)
         self._note_list.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
         self._note_list.setContentsMargins(0, 0, 0, 0)
+        # All rows have the same height, so the view doesn't have to measure every row.
+        self._note_list.setUniformItemSizes(True)
 
         self._previewer.setHidden(True)
 
-    def _on_current_item_changed(self, current: QListWidgetItem, _previous: QListWidgetItem):
-        if current is None or self._enable_previewer is False:
+    def _on_current_changed(self, current: QModelIndex, _previous: QModelIndex):
+        if not current.isValid() or self._enable_previewer is False:
             self._previewer.setHidden(True)
         else:
             self._previewer.setHidden(False)
-            self._previewer.load_note(current.data(self._role), self._other_media_dir)
+            self._previewer.load_note(*self._model.note_ref(current.row()))
+            self._prefetch_neighbours(current.row())
 
-    def selected_notes(self) -> Collection[Note]:
-        return [item.data(self._role) for item in self._note_list.selectedItems()]
+    def _prefetch_neighbours(self, row: int) -> None:
+        """Renders the previous and the next rows ahead, so that moving through the list with arrow keys is smooth."""
+        for neighbour in (row + 1, row - 1):
+            if 0 <= neighbour < self._model.rowCount():
+                package, note_id = self._model.note_ref(neighbour)
+                self._previewer.prefetch(package, [note_id])
 
-    def clear_selection(self):
-        return self._note_list.clearSelection()
+    def selected_rows(self) -> list[int]:
+        return sorted(index.row() for index in self._note_list.selectionModel().selectedRows())
 
-    def clear(self):
-        self._note_list.clear()
+    def note_refs(self, rows: Iterable[int]) -> list[tuple[OpenedPackage, NoteId]]:
+        """Packages and ids of the notes in the rows. Cheap, unlike reading the notes themselves."""
+        return [self._model.note_ref(row) for row in rows]
 
-    def set_notes(self, notes: Iterable[Note], hide_fields: list[str], media_dir: str, previewer: bool = True):
-        self._other_media_dir = media_dir
-        self._enable_previewer = previewer
+    def mark_imported(self, rows: Iterable[int]) -> None:
+        self._model.mark_imported(rows)
 
-        def is_hidden(field_name: str) -> bool:
-            field_name = field_name.lower()
-            return any(hidden_field.lower() in field_name for hidden_field in hide_fields)
+    def clear_selection(self):
+        return self._note_list.clearSelection()
 
-        self.clear()
-        for note in notes:
-            item = QListWidgetItem()
-            item.setText(' | '.join(
-                html_to_text_line(field_content)
-                for field_name, field_content in note.items()
-                if not is_hidden(field_name) and field_content.strip())
-            )
-            item.setData(self._role, note)
-            self._note_list.addItem(item)
+    def clear(self):
+        self._model.clear()
+        self._previewer.setHidden(True)
 
-    def add_notes(self, notes: Iterable[Note], hide_fields: list[str], media_dir: str, previewer: bool = True):
-        self._other_media_dir = media_dir
+    def set_notes(
+            self,
+            package: OpenedPackage,
+            note_ids: Sequence[NoteId],
+            hide_fields: list[str],
+            previewer: bool = True,
+            imported: Iterable[NoteId] = (),
+    ):
+        with span('set_notes', notes=len(note_ids)):
+            self.clear()
+            self.add_notes(package, note_ids, hide_fields, previewer, imported)
+
+    def add_notes(
+            self,
+            package: OpenedPackage,
+            note_ids: Sequence[NoteId],
+            hide_fields: list[str],
+            previewer: bool = True,
+            imported: Iterable[NoteId] = (),
+    ):
         self._enable_previewer = previewer
-
-        def is_hidden(field_name: str) -> bool:
-            field_name = field_name.lower()
-            return any(hidden_field.lower() in field_name for hidden_field in hide_fields)
-
-        for note in notes:
-            item = QListWidgetItem()
-            item.setText(' | '.join(
-                html_to_text_line(field_content)
-                for field_name, field_content in note.items()
-                if not is_hidden(field_name) and field_content.strip())
-            )
-            item.setData(self._role, note)
-            self._note_list.addItem(item)
+        self._model.set_hide_fields(hide_fields)
+        self._model.add_notes(package, note_ids, imported)
@@ -0,0 +1,156 @@
+# Copyright: Ren Tatsumoto <tatsu at autistici.org>
+# Copyright (c) 2023 mizmu addons
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from .common import LogDebug
+from .config import config
+from .package_cache import dir_size
+
+WORKSPACE_DIR_NAME = 'cropro_workspace'
+# Holds the PID of the process that uses a folder.
+OWNER_FILE_NAME = 'owner.pid'
+# Folders without an owner file are left alone for a while, in case their owner is about to write it.
+UNOWNED_GRACE_SECONDS = 60
+
+logDebug = LogDebug()
+
+
+def is_process_alive(pid: int) -> bool:
+    """Errs on the side of "alive", e.g. if the PID was reused, so that nobody's files are deleted by mistake."""
+    if pid == os.getpid():
+        return True
+    if sys.platform == 'win32':
+        # os.kill() would terminate the process on Windows.
+        import ctypes
+        process_query_limited_information = 0x1000
+        error_access_denied = 5
+        still_active = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(process_query_limited_information, False, pid)
+        if not handle:
+            return kernel32.GetLastError() == error_access_denied
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == still_active
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def read_owner(folder: str) -> Optional[int]:
+    try:
+        with open(os.path.join(folder, OWNER_FILE_NAME), encoding='ascii') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+class WorkspaceEntry(NamedTuple):
+    package: str
+    dir: str
+
+    @property
+    def col_path(self) -> str:
+        return os.path.join(self.dir, 'collection.anki2')
+
+
+class Workspace:
+    """
+    Temporary folders for packages that are extracted outside of the package cache.
+    A folder is removed when its package is closed.
+    Each folder records the PID of the process that created it, so that Anki and headless imports
+    running at the same time don't delete each other's folders.
+    Folders whose owner is no longer running are leftovers of a crashed session.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # folder -> entry
+        self._entries: dict[str, WorkspaceEntry] = {}
+
+    @property
+    def root(self) -> str:
+        # The temporary folder may be shared by all users, e.g. /tmp.
+        if hasattr(os, 'getuid'):
+            return os.path.join(tempfile.gettempdir(), f"{WORKSPACE_DIR_NAME}_{os.getuid()}")
+        return os.path.join(tempfile.gettempdir(), WORKSPACE_DIR_NAME)
+
+    @property
+    def quota(self) -> int:
+        """Zero means no limit."""
+        return int(config['workspace_quota_mb']) * 1024 * 1024
+
+    def create(self, package_path: str) -> WorkspaceEntry:
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        entry = WorkspaceEntry(package_path, tempfile.mkdtemp(dir=self.root, prefix='package_'))
+        with self._lock:
+            self._entries[entry.dir] = entry
+        with open(os.path.join(entry.dir, OWNER_FILE_NAME), 'w', encoding='ascii') as f:
+            f.write(str(os.getpid()))
+        return entry
+
+    def remove(self, entry: WorkspaceEntry) -> None:
+        """Deletes the extracted files. The collection must be closed before."""
+        with self._lock:
+            self._entries.pop(entry.dir, None)
+        shutil.rmtree(entry.dir, ignore_errors=True)
+
+    def usage(self) -> dict[str, int]:
+        """Bytes taken up by each package, including media extracted since it was opened."""
+        with self._lock:
+            entries = list(self._entries.values())
+        return {entry.package: dir_size(entry.dir) for entry in entries}
+
+    def used_bytes(self) -> int:
+        return sum(self.usage().values())
+
+    def is_over_quota(self) -> bool:
+        return 0 < self.quota < self.used_bytes()
+
+    def remove_leftovers(self) -> None:
+        """Deletes folders whose owner is no longer running, i.e. everything left behind by a crashed session."""
+        if not os.path.isdir(self.root):
+            return
+        with self._lock:
+            untracked = [entry.path for entry in os.scandir(self.root) if entry.path not in self._entries]
+        leftovers = [path for path in untracked if self._is_leftover(path)]
+        for path in leftovers:
+            logDebug(f"removing leftover workspace folder: {path}")
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+    @staticmethod
+    def _is_leftover(path: str) -> bool:
+        if not os.path.isdir(path):
+            return True
+        if (pid := read_owner(path)) is not None:
+            return not is_process_alive(pid)
+        try:
+            return time.time() - os.path.getmtime(path) > UNOWNED_GRACE_SECONDS
+        except OSError:
+            return False
+
+
+workspace = Workspace()